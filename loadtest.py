@@ -0,0 +1,580 @@
+"""Нагрузочное тестирование бота против локального поддельного Bot API.
+
+Пример:
+    python loadtest.py --chats 50 --users 30 --rate 200 --duration 120 \
+        --spam 0.02 --latency 0.03 --error-rate 0.005 --throttle-rate 0.005
+
+Воспроизведение записанной трассы (TRACE_DIRECTORY) на виртуальных часах:
+    python loadtest.py replay traces/ --tail 3600
+
+Проверка передачи состояния при остановке (в файле должна оказаться отложенная задача):
+    python loadtest.py handoff
+
+Бот запускается в этом же процессе (во временном каталоге данных) и ходит
+в FakeBotAPI через ApplicationBuilder().base_url(...).
+"""
+import os
+import sys
+import json
+import pickle
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+from types import SimpleNamespace
+from collections import defaultdict
+from urllib.parse import parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger('loadtest')
+
+BOT_USER = {
+    'id': 1,
+    'is_bot': True,
+    'first_name': 'LoadTestBot',
+    'username': 'loadtest_bot',
+    'can_join_groups': True,
+    'can_read_all_group_messages': True,
+    'supports_inline_queries': False,
+}
+
+ENFORCEMENT_METHODS = ('restrictChatMember', 'banChatMember')
+
+# Домен не из доверенных, чтобы под нагрузкой работал фильтр ссылок (в том числе ограничение по числу чатов)
+SPAM_LINK = 'https://cheap-followers.example/promo'
+SPAM_TEXT = f"КУПИ ПОДПИСЧИКОВ ДЁШЕВО {SPAM_LINK}"
+
+
+class FakeBotAPI:
+    """Подмножество Bot API, которое использует бот, с задержкой, ошибками и ответами 429"""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, throttle_rate=0.0, retry_after=1, admins=()):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.admins = set(admins)
+
+        self.call_counts = defaultdict(int)
+        self.injected_errors = 0
+        self.throttled = 0
+        self.delivered = 0
+        self.on_call = None
+
+        self._updates = []
+        self._next_update_id = 1
+        self._bot_message_ids = defaultdict(lambda: 10_000_000)
+        self._cond = threading.Condition()
+
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-bot-api', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def push_update(self, payload: dict):
+        """Кладёт апдейт в очередь getUpdates"""
+        with self._cond:
+            payload['update_id'] = self._next_update_id
+            self._next_update_id += 1
+            self._updates.append(payload)
+            self._cond.notify_all()
+
+    def _make_handler(api):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело уходят разными send: без TCP_NODELAY на keep-alive
+            # алгоритм Нейгла и отложенный ACK добавляли к каждому вызову ~40 мс
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                api._handle(self)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _parse_params(self, content_type: str, body: bytes) -> dict:
+        if not body:
+            return {}
+        if content_type.startswith('application/json'):
+            return json.loads(body)
+
+        params = {}
+        for key, value in parse_qsl(body.decode('utf-8'), keep_blank_values=True):
+            # python-telegram-bot кодирует не-строковые параметры в JSON
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        return params
+
+    def _respond(self, request, status: int, payload: dict):
+        body = json.dumps(payload).encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _handle(self, request):
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length else b''
+        method = request.path.rsplit('/', 1)[-1]
+        params = self._parse_params(request.headers.get('Content-Type', ''), body)
+        self.call_counts[method] += 1
+
+        if method not in ('getUpdates', 'getMe', 'deleteWebhook'):
+            delay = self.latency + random.uniform(0, self.jitter)
+            if delay > 0:
+                time.sleep(delay)
+            if random.random() < self.throttle_rate:
+                self.throttled += 1
+                self._respond(request, 429, {
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f"Too Many Requests: retry after {self.retry_after}",
+                    'parameters': {'retry_after': self.retry_after},
+                })
+                return
+            if random.random() < self.error_rate:
+                self.injected_errors += 1
+                self._respond(request, 400, {
+                    'ok': False,
+                    'error_code': 400,
+                    'description': 'Bad Request: injected error',
+                })
+                return
+
+        handler = getattr(self, f"_api_{method}", None)
+        result = handler(params) if handler else True
+        if self.on_call is not None:
+            self.on_call(method, params, time.monotonic())
+        self._respond(request, 200, {'ok': True, 'result': result})
+
+    def _api_getMe(self, params):
+        return BOT_USER
+
+    def _api_getUpdates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+
+        with self._cond:
+            if offset:
+                self._updates = [update for update in self._updates if update['update_id'] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._updates[:limit]
+
+        self.delivered += len(batch)
+        return batch
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params['chat_id'])
+        self._bot_message_ids[chat_id] += 1
+        return {
+            'message_id': int(params.get('message_id') or self._bot_message_ids[chat_id]),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': f"chat {chat_id}"},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }
+
+    def _api_sendMessage(self, params):
+        return self._message(params)
+
+    def _api_editMessageText(self, params):
+        return self._message(params)
+
+    def _api_getChatMember(self, params):
+        user_id = int(params['user_id'])
+        user = {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+        if user_id in self.admins:
+            return {
+                'status': 'administrator',
+                'user': user,
+                'can_be_edited': False,
+                'is_anonymous': False,
+                'can_manage_chat': True,
+                'can_delete_messages': True,
+                'can_manage_video_chats': True,
+                'can_restrict_members': True,
+                'can_promote_members': False,
+                'can_change_info': True,
+                'can_invite_users': True,
+            }
+        return {'status': 'member', 'user': user}
+
+
+def percentile(values, share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+class Scenario:
+    """Поток сообщений обычных пользователей плюс всплески спама от свежих аккаунтов"""
+
+    def __init__(self, api: FakeBotAPI, chats: int, users: int, rate: float,
+                 spam_share: float, burst: int, duration: float):
+        self.api = api
+        self.chats = [-1_000_000_000_000 - i for i in range(chats)]
+        self.users = users
+        self.rate = rate
+        self.spam_share = spam_share
+        self.burst = burst
+        self.duration = duration
+
+        self.injected = 0
+        self._message_ids = defaultdict(int)
+        self._next_spammer = 50_000_000
+        self._spam_messages = {}
+        self._burst_started = {}
+        self._first_deletion = {}
+        self._first_enforcement = {}
+
+        api.on_call = self.observe
+
+    def _push_message(self, chat_id: int, user_id: int, text: str, entities: list = None) -> int:
+        self._message_ids[chat_id] += 1
+        message_id = self._message_ids[chat_id]
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': f"chat {chat_id}"},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}", 'username': f"user{user_id}"},
+            'text': text,
+        }
+        if entities:
+            message['entities'] = entities
+        self.api.push_update({'message': message})
+        self.injected += 1
+        return message_id
+
+    def _spam_burst(self):
+        chat_id = random.choice(self.chats)
+        user_id = self._next_spammer
+        self._next_spammer += 1
+        key = (chat_id, user_id)
+        self._burst_started[key] = time.monotonic()
+        for _ in range(self.burst):
+            # Смещения сущностей в UTF-16; в тексте только символы BMP, поэтому len подходит
+            entity = {'type': 'url', 'offset': SPAM_TEXT.index(SPAM_LINK), 'length': len(SPAM_LINK)}
+            message_id = self._push_message(chat_id, user_id, SPAM_TEXT, [entity])
+            self._spam_messages[(chat_id, message_id)] = key
+
+    def observe(self, method: str, params: dict, ts: float):
+        """Засекает первую реакцию модерации на каждый всплеск спама"""
+        if method == 'deleteMessage':
+            key = self._spam_messages.get((int(params['chat_id']), int(params['message_id'])))
+            if key and key not in self._first_deletion:
+                self._first_deletion[key] = ts
+        elif method == 'deleteMessages':
+            for message_id in params.get('message_ids', ()):
+                key = self._spam_messages.get((int(params['chat_id']), int(message_id)))
+                if key and key not in self._first_deletion:
+                    self._first_deletion[key] = ts
+        elif method in ENFORCEMENT_METHODS:
+            key = (int(params['chat_id']), int(params['user_id']))
+            if key in self._burst_started and key not in self._first_enforcement:
+                self._first_enforcement[key] = ts
+
+    async def run(self):
+        interval = 1.0 / self.rate
+        started = time.monotonic()
+        next_at = started
+        while time.monotonic() - started < self.duration:
+            if random.random() < self.spam_share:
+                self._spam_burst()
+            else:
+                # У каждого чата свои участники: --users задаётся на чат
+                chat_index = random.randrange(len(self.chats))
+                chat_id = self.chats[chat_index]
+                user_id = 1000 + chat_index * self.users + random.randint(1, self.users)
+                self._push_message(chat_id, user_id, f"сообщение {random.randint(1, 10 ** 6)}")
+            next_at += interval
+            await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+
+    def report(self, elapsed: float, drain_time: float, processed: int) -> dict:
+        deletion = [self._first_deletion[key] - start for key, start in self._burst_started.items() if key in self._first_deletion]
+        enforcement = [self._first_enforcement[key] - start for key, start in self._burst_started.items() if key in self._first_enforcement]
+        return {
+            'elapsed_seconds': round(elapsed, 2),
+            'drain_seconds': round(drain_time, 2),
+            'updates_injected': self.injected,
+            'updates_delivered': self.api.delivered,
+            'updates_processed': processed,
+            'throughput_per_second': round(processed / elapsed, 1) if elapsed else 0.0,
+            'api_calls': dict(self.api.call_counts),
+            'injected_errors': self.api.injected_errors,
+            'throttled_429': self.api.throttled,
+            'spam_bursts': len(self._burst_started),
+            'first_deletion_seconds': {
+                'count': len(deletion),
+                'p50': round(percentile(deletion, 0.5), 3),
+                'p95': round(percentile(deletion, 0.95), 3),
+                'max': round(max(deletion), 3) if deletion else 0.0,
+            },
+            'enforcement_seconds': {
+                'count': len(enforcement),
+                'p50': round(percentile(enforcement, 0.5), 3),
+                'p95': round(percentile(enforcement, 0.95), 3),
+                'max': round(max(enforcement), 3) if enforcement else 0.0,
+            },
+        }
+
+
+async def run_loadtest(args) -> dict:
+    api = FakeBotAPI(
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+    )
+    api.start()
+    logger.info("Поддельный Bot API слушает %s", api.base_url)
+
+    # Данные бота пишутся во временный каталог, чтобы не трогать рабочую базу
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix='titobot-loadtest-')
+    os.chdir(workdir)
+    sys.path.insert(0, repo_dir)
+    import main as bot
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    application = bot.build_application('123456:LOADTEST', base_url=api.base_url)
+
+    # Последняя группа обработчиков: апдейт засчитывается, когда бот закончил с ним работать
+    processed = SimpleNamespace(count=0)
+
+    async def count_processed(update, context):
+        processed.count += 1
+
+    application.add_handler(TypeHandler(Update, count_processed), group=100)
+    scenario = Scenario(api, args.chats, args.users, args.rate, args.spam, args.burst, args.duration)
+
+    async with application:
+        await application.start()
+        await application.updater.start_polling(poll_interval=0.0, timeout=1)
+
+        started = time.monotonic()
+        await scenario.run()
+        elapsed = time.monotonic() - started
+
+        drain_started = time.monotonic()
+        while processed.count < scenario.injected and time.monotonic() - drain_started < args.drain_timeout:
+            await asyncio.sleep(0.1)
+        if processed.count < scenario.injected:
+            logger.warning(
+                "Бот не успел обработать %s апдейтов за %s с", scenario.injected - processed.count, args.drain_timeout
+            )
+        await asyncio.sleep(args.grace)
+        drain_time = time.monotonic() - drain_started
+
+        await application.updater.stop()
+        await application.stop()
+
+    api.stop()
+    bot.db.flush()
+    logger.info("Данные прогона сохранены в %s", workdir)
+    return scenario.report(elapsed + drain_time, drain_time, processed.count)
+
+
+def trace_paths(targets) -> list:
+    """Раскрывает каталоги трасс в отсортированный список файлов"""
+    paths = []
+    for target in targets:
+        if os.path.isdir(target):
+            paths.extend(sorted(
+                os.path.join(target, name) for name in os.listdir(target)
+                if name.startswith('trace_') and name.endswith('.jsonl.gz')
+            ))
+        else:
+            paths.append(target)
+    return [os.path.abspath(path) for path in paths]
+
+
+async def run_replay(args) -> dict:
+    paths = trace_paths(args.traces)
+    api = FakeBotAPI()
+    api.start()
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix='titobot-replay-')
+    os.chdir(workdir)
+    sys.path.insert(0, repo_dir)
+    import main as bot
+    from telegram import Update
+
+    trace = bot.iter_trace(paths)
+    first = next(trace, None)
+    if first is None:
+        api.stop()
+        return {'updates_replayed': 0}
+
+    bot.clock = bot.VirtualClock(first[0])
+    application = bot.build_application('123456:REPLAY', base_url=api.base_url)
+
+    def make_context(data):
+        return SimpleNamespace(
+            bot=application.bot,
+            application=application,
+            job_queue=application.job_queue,
+            job=SimpleNamespace(data=data),
+        )
+
+    replayed = 0
+    first_ts = last_ts = first[0]
+    started = time.monotonic()
+
+    async with application:
+        pending = first
+        while pending is not None:
+            ts, update_data = pending
+            if args.speed and ts > last_ts:
+                await asyncio.sleep((ts - last_ts) / args.speed)
+            await bot.clock.advance(ts, make_context)
+            await application.process_update(Update.de_json(update_data, application.bot))
+            replayed += 1
+            last_ts = ts
+            pending = next(trace, None)
+
+        await bot.clock.advance(last_ts + args.tail, make_context)
+
+    elapsed = time.monotonic() - started
+    api.stop()
+    bot.db.flush()
+    logger.info("Данные воспроизведения сохранены в %s", workdir)
+
+    virtual_span = last_ts - first_ts + args.tail
+    return {
+        'updates_replayed': replayed,
+        'virtual_seconds': round(virtual_span, 1),
+        'real_seconds': round(elapsed, 2),
+        'speedup': round(virtual_span / elapsed, 1) if elapsed else 0.0,
+        'timers_left': bot.clock.pending_timers,
+        'api_calls': dict(api.call_counts),
+    }
+
+
+def replay_main(argv):
+    parser = argparse.ArgumentParser(prog='loadtest.py replay', description='Воспроизведение трассы апдейтов на виртуальных часах')
+    parser.add_argument('traces', nargs='+', help='файлы trace_*.jsonl.gz или каталоги с ними')
+    parser.add_argument('--speed', type=float, default=0.0, help='ускорение относительно записи; 0 - без пауз')
+    parser.add_argument('--tail', type=float, default=3600.0, help='сколько виртуальных секунд прогнать после последнего апдейта')
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run_replay(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+async def run_handoff_check(args) -> dict:
+    """Останавливает настоящий бот с запланированным удалением и проверяет, что задача попала в файл передачи"""
+    api = FakeBotAPI(port=args.port, latency=0.0, jitter=0.0)
+    api.start()
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix='titobot-handoff-')
+    os.chdir(workdir)
+    sys.path.insert(0, repo_dir)
+    import main as bot
+
+    application = bot.build_application('123456:LOADTEST', base_url=api.base_url)
+    stop = asyncio.Event()
+    serving = asyncio.create_task(bot.serve([application], stop))
+    while not (application.updater and application.updater.running):
+        if serving.done():
+            await serving
+        await asyncio.sleep(0.05)
+
+    expected = (-1001, [42])
+    bot.clock.run_once(application.job_queue, bot.delete_messages_job, args.delay, data=expected)
+    stop.set()
+    await serving
+    api.stop()
+
+    with open(bot.HANDOFF_SETTINGS['path'], 'rb') as f:
+        payload = pickle.load(f)
+    jobs = payload['jobs'].get('', [])
+    return {
+        'handoff': os.path.join(workdir, bot.HANDOFF_SETTINGS['path']),
+        'jobs': [(name, round(due - payload['written'], 1), data) for name, due, data in jobs],
+        'ok': any(name == 'delete_messages' and data == expected for name, _, data in jobs),
+    }
+
+
+def handoff_main(argv):
+    parser = argparse.ArgumentParser(prog='loadtest.py handoff', description='Проверка передачи задач при остановке бота')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--delay', type=float, default=60.0, help='через сколько секунд должна сработать задача')
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run_handoff_check(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if not report['ok']:
+        sys.exit(1)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'replay':
+        replay_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'handoff':
+        handoff_main(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон бота против поддельного Bot API')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--users', type=int, default=50, help='обычных пользователей на чат')
+    parser.add_argument('--rate', type=float, default=50.0, help='сообщений в секунду')
+    parser.add_argument('--spam', type=float, default=0.02, help='доля тиков, начинающих всплеск спама')
+    parser.add_argument('--burst', type=int, default=8, help='сообщений во всплеске спама')
+    parser.add_argument('--duration', type=float, default=30.0, help='длительность нагрузки, с')
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка ответа API, с')
+    parser.add_argument('--jitter', type=float, default=0.02, help='случайная добавка к задержке, с')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--drain-timeout', type=float, default=60.0)
+    parser.add_argument('--grace', type=float, default=2.0, help='ожидание отложенных действий после разбора очереди, с')
+    args = parser.parse_args()
+
+    report = asyncio.run(run_loadtest(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
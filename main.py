@@ -1,70 +1,613 @@
 import os
+import csv
+import sys
+import gzip
 import json
 import time
+import zlib
+import base64
+import math
+import array
+import heapq
+import signal
+import hashlib
+import pickle
+import shutil
+import queue
+import atexit
 import asyncio
 import logging
+import logging.handlers
+import argparse
+import itertools
+import threading
+import contextvars
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from typing import Dict, List, Optional
-from collections import defaultdict, deque
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
 
-from telegram import Update, ChatMember, ChatPermissions, InlineKeyboardButton, InlineKeyboardMarkup
+import httpx
+from telegram import Update, ChatMember, ChatPermissions, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     ChatMemberHandler,
     CallbackQueryHandler,
+    TypeHandler,
+    CallbackContext,
     filters,
     ContextTypes
 )
 from telegram.constants import ChatMemberStatus
+from telegram.error import RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
+
+# Настройка логирования: обработчики только кладут записи в очередь, форматирует и пишет их отдельный поток
+LOG_SETTINGS = {
+    'level': os.environ.get('LOG_LEVEL', 'INFO'),
+    # text - как раньше, json - одна запись в строке для сборщиков логов
+    'format': os.environ.get('LOG_FORMAT', 'text'),
+    # Уровни подсистем ("spam=WARNING,db=DEBUG"), можно указывать и сторонние логгеры
+    'levels': os.environ.get('LOG_LEVELS', 'httpx=WARNING'),
+    # Одинаковые по шаблону записи ниже WARNING: не больше rate_burst за rate_window секунд
+    'rate_window': 60,
+    'rate_burst': 10,
+    'queue_size': 10000,
+}
+
+LOG_SUBSYSTEMS = ('spam', 'db', 'joins', 'transport')
+
+# Чат и пользователь обрабатываемого апдейта, добавляются к каждой записи
+log_context = contextvars.ContextVar('log_context', default=(None, None))
+
+class LogContextFilter(logging.Filter):
+    """Дописывает в запись бота, чат и пользователя, если их не передали через extra"""
+
+    def filter(self, record):
+        chat_id, user_id = log_context.get()
+        if not hasattr(record, 'chat_id'):
+            record.chat_id = chat_id
+        if not hasattr(record, 'user_id'):
+            record.user_id = user_id
+        record.bot = storage_namespace.get()
+        return True
+
+class LogRateLimiter(logging.Filter):
+    """Ограничивает повторяющиеся записи: ключ - логгер и шаблон сообщения.
+
+    Шаблон у ленивых %-записей один на место вызова, поэтому, например,
+    запись о каждой GIF не забивает лог. Число пропущенных попадает в первую
+    запись следующего окна. WARNING и выше проходят всегда.
+    """
+
+    def __init__(self, window: float, burst: int, max_keys: int = 1000):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.max_keys = max_keys
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            started, count, suppressed = self._windows.get(key, (record.created, 0, 0))
+            if record.created - started >= self.window:
+                if suppressed:
+                    record.suppressed = suppressed
+                started, count, suppressed = record.created, 0, 0
+            count += 1
+            passed = count <= self.burst
+            if len(self._windows) >= self.max_keys and key not in self._windows:
+                self._windows.clear()
+            self._windows[key] = (started, count, suppressed + (not passed))
+        return passed
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        if getattr(record, 'suppressed', 0):
+            text += f" (похожих записей пропущено: {record.suppressed})"
+        return text
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна JSON-запись в строке"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in ('bot', 'chat_id', 'user_id', 'suppressed'):
+            value = getattr(record, field, None)
+            if value not in (None, ''):
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь без форматирования; при переполненной очереди запись отбрасывается"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging(logger: logging.Logger):
+    """Подключает корневой логгер к очереди и выставляет уровни подсистем"""
+    logging.getLogger().setLevel(LOG_SETTINGS['level'].upper())
+    for item in LOG_SETTINGS['levels'].split(','):
+        if '=' not in item:
+            continue
+        name, level = (part.strip() for part in item.split('=', 1))
+        target = logger.getChild(name) if name in LOG_SUBSYSTEMS else logging.getLogger(name)
+        target.setLevel(level.upper())
+
+    root = logging.getLogger()
+    if root.handlers:
+        # Как и basicConfig, не трогаем уже настроенный вывод (например, у нагрузочного теста)
+        return None
+
+    if LOG_SETTINGS['format'] == 'json':
+        formatter = JsonLogFormatter()
+    else:
+        formatter = TextLogFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    handler = LazyQueueHandler(queue.Queue(LOG_SETTINGS['queue_size']))
+    handler.addFilter(LogRateLimiter(LOG_SETTINGS['rate_window'], LOG_SETTINGS['rate_burst']))
+    handler.addFilter(LogContextFilter())
+    root.addHandler(handler)
+
+    listener = logging.handlers.QueueListener(handler.queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return handler
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
+log_handler = setup_logging(logger)
+spam_logger = logger.getChild('spam')
+db_logger = logger.getChild('db')
+joins_logger = logger.getChild('joins')
+transport_logger = logger.getChild('transport')
+
+PROCESS_STARTED = time.monotonic()
+startup_stats = {}
+
+# Источник времени: реальный в работе, виртуальный при воспроизведении трасс
+class SystemClock:
+    """Реальное время и планировщик job_queue"""
+
+    def time(self) -> float:
+        return time.time()
+
+    def now(self) -> datetime:
+        return datetime.now()
+
+    def run_once(self, job_queue, callback, when, data=None):
+        return job_queue.run_once(callback, when, data=data)
+
+class VirtualClock(SystemClock):
+    """Управляемое время: таймеры срабатывают, когда время переводят вперёд"""
+
+    def __init__(self, start: float):
+        self._now = start
+        self._timers = []
+        self._sequence = itertools.count()
+
+    def time(self) -> float:
+        return self._now
+
+    def now(self) -> datetime:
+        return datetime.fromtimestamp(self._now)
+
+    def run_once(self, job_queue, callback, when, data=None):
+        heapq.heappush(self._timers, (self._now + when, next(self._sequence), callback, data))
+
+    @property
+    def pending_timers(self) -> int:
+        return len(self._timers)
+
+    async def advance(self, target: float, make_context):
+        """Переводит время на target, по порядку выполняя созревшие таймеры"""
+        while self._timers and self._timers[0][0] <= target:
+            due, _, callback, data = heapq.heappop(self._timers)
+            self._now = max(self._now, due)
+            try:
+                await callback(make_context(data))
+            except Exception as e:
+                logger.error("Ошибка в отложенной задаче при воспроизведении: %s", e)
+        self._now = max(self._now, target)
 
-# Простая файловая база данных
+clock = SystemClock()
+
+# Настройки хранилища
+DB_SETTINGS = {
+    'memory_budget': int(os.environ.get('DB_MEMORY_BUDGET', 32 * 1024 * 1024)),
+    'flush_interval': 5,
+    'user_shard_buckets': 64,
+    'warm_start': os.environ.get('DB_WARM_START', '1') == '1',
+}
+
+# Префиксы ключей, которые хранятся в шарде конкретного чата / группы пользователей
+CHAT_SHARD_PREFIXES = ('settings_', 'rules_', 'marriages_', 'chat_words_', 'admins_', 'warnings_', 'usernames_', 'banned_words_', 'links_', 'analytics_')
+USER_SHARD_PREFIXES = ('recent_texts_', 'recent_media_', 'expiry_')
+
+GLOBAL_SHARD = 'global'
+
+# Пространство имён хранилища текущего бота (при запуске нескольких ботов в одном процессе)
+storage_namespace = contextvars.ContextVar('storage_namespace', default='')
+
+def chat_scope(chat_id: int) -> tuple:
+    """Ключ для состояния в памяти, которое у каждого бота своё"""
+    return storage_namespace.get(), chat_id
+
+# Сжатие крупных редко используемых значений
+COLD_STORAGE_SETTINGS = {
+    'prefixes': ('chat_words_', 'rules_', 'recent_texts_'),
+    'min_size': 1024,
+    'idle_after': 600,
+}
+
+class CompressedValue:
+    """Значение, сжатое zlib; разжимается при первом обращении"""
+    __slots__ = ('blob',)
+
+    def __init__(self, blob: bytes):
+        self.blob = blob
+
+    def unpack(self):
+        return json.loads(zlib.decompress(self.blob).decode('utf-8'))
+
+    def to_json(self) -> dict:
+        return {'__zlib__': base64.b64encode(self.blob).decode('ascii')}
+
+def key_prefix(key: str) -> str:
+    """Префикс ключа без идентификатора чата или пользователя: settings_-100 -> settings_"""
+    return key.rstrip('-0123456789')
+
+def _encode_stored_value(value):
+    if isinstance(value, CompressedValue):
+        return value.to_json()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+# Простая файловая база данных, разбитая на шарды по чатам
 class SimpleDB:
-    def __init__(self, filename='chat_manager_data.json'):
+    def __init__(self, filename='chat_manager_data.json', directory=None, memory_budget=None):
         self.filename = filename
-        self.data = self._load_data()
+        self.directory = directory or os.path.splitext(filename)[0]
+        self.memory_budget = memory_budget if memory_budget is not None else DB_SETTINGS['memory_budget']
+        self.flush_interval = DB_SETTINGS['flush_interval']
+        self.user_buckets = DB_SETTINGS['user_shard_buckets']
+
+        self._shards = OrderedDict()
+        self._sizes = {}
+        self._dirty = set()
+        self._touched = OrderedDict()
+        self._resident = 0
+        self._last_flush = time.monotonic()
+        # Учёт для /stats: ключи загруженных шардов по префиксам и последний известный размер каждого шарда
+        self.key_counts = Counter()
+        self.footprints = {}
+
+        self.warm_start_path = f"{os.path.splitext(filename)[0]}.warm"
+
+        self._migrate_legacy()
+        self._load()
+
+    def _load(self):
+        started = time.monotonic()
+        warm_shards = self._load_warm_start() if DB_SETTINGS['warm_start'] else 0
+        if GLOBAL_SHARD not in self._sizes:
+            self.data = self._load_data(GLOBAL_SHARD)
+            self._count_keys(self.data, 1)
+        startup_stats['db_load_seconds'] = time.monotonic() - started
+        startup_stats['db_warm_shards'] = warm_shards
+
+    def reload(self):
+        """Забывает загруженные шарды и читает базу заново (после того, как её дописал другой процесс)"""
+        self._shards.clear()
+        self._sizes.clear()
+        self._dirty.clear()
+        self._touched.clear()
+        self._resident = 0
+        self.key_counts.clear()
+        self.footprints.clear()
+        self._load()
+
+    def _shard_id(self, key) -> str:
+        """Определяет шард, в котором хранится ключ"""
+        for prefix in CHAT_SHARD_PREFIXES:
+            if key.startswith(prefix):
+                suffix = key[len(prefix):]
+                if suffix.lstrip('-').isdigit():
+                    return self._namespaced(f"chat_{suffix}")
+        for prefix in USER_SHARD_PREFIXES:
+            if key.startswith(prefix):
+                suffix = key[len(prefix):]
+                if suffix.isdigit():
+                    return self._namespaced(f"users_{int(suffix) % self.user_buckets}")
+        return self._namespaced(GLOBAL_SHARD)
+
+    def _namespaced(self, shard_id) -> str:
+        # Шарды других ботов лежат рядом с файлами по умолчанию: brand.chat_-100.json
+        namespace = storage_namespace.get()
+        return f"{namespace}.{shard_id}" if namespace else shard_id
+
+    def _shard_path(self, shard_id) -> str:
+        return os.path.join(self.directory, f"{shard_id}.json")
+
+    def _migrate_legacy(self):
+        """Разбивает старый единый файл на шарды (однократно)"""
+        if os.path.isdir(self.directory):
+            return
+        os.makedirs(self.directory, exist_ok=True)
 
-    def _load_data(self):
         try:
             with open(self.filename, 'r', encoding='utf-8') as f:
-                return json.load(f)
+                legacy = json.load(f)
         except (FileNotFoundError, json.JSONDecodeError):
-            return {}
+            return
+
+        shards = defaultdict(dict)
+        for key, value in legacy.items():
+            shards[self._shard_id(key)][key] = value
+        for shard_id, shard in shards.items():
+            self._write_shard(shard_id, shard)
+        db_logger.info("Данные из %s разбиты на %s шардов", self.filename, len(shards))
+
+    def _read_shard(self, shard_id):
+        """Читает и разбирает файл шарда, не трогая состояние базы (можно вызывать из другого потока)"""
+        signature = self._file_signature(shard_id)
+        try:
+            with open(self._shard_path(shard_id), 'r', encoding='utf-8') as f:
+                raw = f.read()
+            data = json.loads(raw)
+        except (FileNotFoundError, json.JSONDecodeError):
+            raw, data = '', {}
+        for key, value in data.items():
+            if isinstance(value, dict) and '__zlib__' in value:
+                data[key] = CompressedValue(base64.b64decode(value['__zlib__']))
+        return signature, len(raw), data
+
+    def _load_data(self, shard_id, loaded=None):
+        _, size, data = loaded or self._read_shard(shard_id)
+        self._sizes[shard_id] = self.footprints[shard_id] = size
+
+        for key, value in data.items():
+            if key.startswith(COLD_STORAGE_SETTINGS['prefixes']) and not isinstance(value, CompressedValue):
+                self._touch(shard_id, key)
+        return data
+
+    async def load_shard(self, shard_id):
+        """Загружает шард, читая и разбирая файл в отдельном потоке, чтобы не задерживать цикл событий"""
+        shard_id = self._namespaced(shard_id)
+        if shard_id == GLOBAL_SHARD or shard_id in self._shards:
+            return
+        loaded = await asyncio.to_thread(self._read_shard, shard_id)
+        if shard_id in self._shards:
+            return
+        # Пока файл читался, шард могли загрузить, изменить и выгрузить заново - тогда прочитанное устарело
+        if loaded[0] != self._file_signature(shard_id):
+            loaded = None
+        self._shard(shard_id, loaded)
+
+    def is_resident(self, shard_id) -> bool:
+        return self._namespaced(shard_id) in self._shards
+
+    def _file_signature(self, shard_id):
+        try:
+            stat = os.stat(self._shard_path(shard_id))
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def write_warm_start(self):
+        """Сохраняет глобальный и горячие шарды в бинарный файл для быстрого старта"""
+        self.flush()
+        shards = [(GLOBAL_SHARD, self.data)] + list(self._shards.items())
+        payload = {
+            'version': 1,
+            'shards': [(shard_id, self._file_signature(shard_id), self._sizes.get(shard_id, 0), shard) for shard_id, shard in shards],
+        }
+        tmp_path = f"{self.warm_start_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.warm_start_path)
+
+    def _load_warm_start(self) -> int:
+        """Поднимает шарды из бинарного файла; шарды, изменённые после его записи, читаются из JSON"""
+        try:
+            with open(self.warm_start_path, 'rb') as f:
+                payload = pickle.load(f)
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            db_logger.warning("Файл быстрого старта %s не прочитан, загрузка из JSON: %s", self.warm_start_path, e)
+            return 0
+
+        loaded = 0
+        for shard_id, signature, size, shard in payload.get('shards', ()):
+            if signature is None or signature != self._file_signature(shard_id):
+                continue
+            if shard_id == GLOBAL_SHARD:
+                self.data = shard
+            else:
+                self._shards[shard_id] = shard
+                self._resident += size
+            self._sizes[shard_id] = self.footprints[shard_id] = size
+            self._count_keys(shard, 1)
+            for key, value in shard.items():
+                if key.startswith(COLD_STORAGE_SETTINGS['prefixes']) and not isinstance(value, CompressedValue):
+                    self._touch(shard_id, key)
+            loaded += 1
+
+        self._evict_cold()
+        return loaded
+
+    def _write_shard(self, shard_id, shard) -> int:
+        path = self._shard_path(shard_id)
+        tmp_path = f"{path}.tmp"
+        raw = json.dumps(shard, ensure_ascii=False, indent=2, default=_encode_stored_value)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(raw)
+        os.replace(tmp_path, path)
+        return len(raw)
+
+    def _flush_shard(self, shard_id):
+        shard = self.data if shard_id == GLOBAL_SHARD else self._shards.get(shard_id)
+        if shard is None:
+            return
+        size = self._write_shard(shard_id, shard)
+        if shard_id in self._shards:
+            self._resident += size - self._sizes.get(shard_id, 0)
+        self._sizes[shard_id] = self.footprints[shard_id] = size
+        self._dirty.discard(shard_id)
+
+    def _count_keys(self, shard, sign: int):
+        for key in shard:
+            self.key_counts[key_prefix(key)] += sign
+
+    def _touch(self, shard_id, key):
+        self._touched[shard_id, key] = time.monotonic()
+        self._touched.move_to_end((shard_id, key))
+
+    def _compress_idle_values(self):
+        """Сжимает крупные значения, к которым давно не обращались"""
+        deadline = time.monotonic() - COLD_STORAGE_SETTINGS['idle_after']
+        while self._touched:
+            (shard_id, key), touched = next(iter(self._touched.items()))
+            if touched > deadline:
+                break
+            del self._touched[shard_id, key]
+
+            shard = self.data if shard_id == GLOBAL_SHARD else self._shards.get(shard_id)
+            value = shard.get(key) if shard is not None else None
+            if value is None or isinstance(value, CompressedValue):
+                continue
+
+            raw = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            if len(raw) < COLD_STORAGE_SETTINGS['min_size']:
+                continue
+            shard[key] = CompressedValue(zlib.compress(raw, 6))
+            self._dirty.add(shard_id)
 
     def _save_data(self):
-        with open(self.filename, 'w', encoding='utf-8') as f:
-            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        """Сбрасывает на диск все изменённые шарды"""
+        self._compress_idle_values()
+        for shard_id in list(self._dirty):
+            self._flush_shard(shard_id)
+        self._last_flush = time.monotonic()
+        self._evict_cold()
+
+    def flush(self):
+        self._save_data()
+
+    def _shard(self, shard_id, loaded=None) -> dict:
+        """Возвращает шард, загружая его при первом обращении"""
+        if shard_id == GLOBAL_SHARD:
+            return self.data
+
+        shard = self._shards.get(shard_id)
+        if shard is not None:
+            self._shards.move_to_end(shard_id)
+            return shard
+
+        shard = self._load_data(shard_id, loaded)
+        self._shards[shard_id] = shard
+        self._resident += self._sizes[shard_id]
+        self._count_keys(shard, 1)
+        self._evict_cold()
+        return shard
+
+    def _evict_cold(self):
+        """Выгружает самые давно использованные шарды при превышении бюджета"""
+        while self._resident > self.memory_budget and len(self._shards) > 1:
+            shard_id = next(iter(self._shards))
+            if shard_id in self._dirty:
+                self._flush_shard(shard_id)
+            self._count_keys(self._shards.pop(shard_id), -1)
+            self._resident -= self._sizes.pop(shard_id, 0)
 
     def get(self, key, default=None):
-        return self.data.get(key, default)
+        shard_id = self._shard_id(key)
+        shard = self._shard(shard_id)
+        value = shard.get(key, default)
+        if isinstance(value, CompressedValue):
+            value = shard[key] = value.unpack()
+        if key.startswith(COLD_STORAGE_SETTINGS['prefixes']):
+            self._touch(shard_id, key)
+        return value
 
     def set(self, key, value):
-        self.data[key] = value
-        self._save_data()
+        shard_id = self._shard_id(key)
+        shard = self._shard(shard_id)
+        if key not in shard:
+            self.key_counts[key_prefix(key)] += 1
+        shard[key] = value
+        self._dirty.add(shard_id)
+        if key.startswith(COLD_STORAGE_SETTINGS['prefixes']):
+            self._touch(shard_id, key)
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self._save_data()
+
+    def delete(self, key) -> bool:
+        shard_id = self._shard_id(key)
+        shard = self._shard(shard_id)
+        if key not in shard:
+            return False
+        del shard[key]
+        self.key_counts[key_prefix(key)] -= 1
+        self._touched.pop((shard_id, key), None)
+        self._dirty.add(shard_id)
+        return True
+
+    def stats(self) -> dict:
+        """Размер и состояние шардов для /stats"""
+        return {
+            'resident_bytes': self._resident,
+            'resident_shards': len(self._shards),
+            'dirty_shards': len(self._dirty),
+            'known_shards': len(self.footprints),
+        }
+
+    def shard_keys(self, shard_id) -> list:
+        """Ключи шарда в пространстве имён текущего бота"""
+        return list(self._shard(self._namespaced(shard_id)))
 
     def __contains__(self, key):
-        return key in self.data
+        return key in self._shard(self._shard_id(key))
 
     def __getitem__(self, key):
-        return self.data[key]
+        if key not in self:
+            raise KeyError(key)
+        return self.get(key)
 
     def __setitem__(self, key, value):
-        self.data[key] = value
-        self._save_data()
+        self.set(key, value)
 
 db = SimpleDB()
+atexit.register(db.flush)
 
 # Глобальные переменные для антиспам системы
 user_message_history = defaultdict(lambda: deque(maxlen=10))
-user_warnings = defaultdict(int)
 
 # Настройки антиспама
 SPAM_SETTINGS = {
@@ -78,6 +621,594 @@ SPAM_SETTINGS = {
     'media_flood_protection': True,
 }
 
+class WarningLedger:
+    """Предупреждения по паре (чат, пользователь) с ленивым затуханием.
+
+    В шарде чата хранится только пара [count, last_ts]; каждое полное окно
+    warning_reset_time без новых нарушений снимает одно предупреждение.
+    Затухание считается при чтении, фоновых проходов нет.
+    """
+
+    def __init__(self, storage, reset_time: int):
+        self.storage = storage
+        self.reset_time = reset_time
+
+    def _key(self, chat_id: int) -> str:
+        return f"warnings_{chat_id}"
+
+    def _decayed(self, entry, now: float) -> int:
+        count, last_ts = entry
+        if self.reset_time <= 0:
+            return count
+        return max(0, count - int((now - last_ts) // self.reset_time))
+
+    def get(self, chat_id: int, user_id: int, now: float = None) -> int:
+        entry = self.storage.get(self._key(chat_id), {}).get(str(user_id))
+        if entry is None:
+            return 0
+        return self._decayed(entry, now if now is not None else clock.time())
+
+    def add(self, chat_id: int, user_id: int, now: float = None) -> int:
+        now = now if now is not None else clock.time()
+        key = self._key(chat_id)
+        ledger = self.storage.get(key, {})
+        entry = ledger.get(str(user_id))
+        count = (self._decayed(entry, now) if entry else 0) + 1
+        ledger[str(user_id)] = [count, now]
+        self.storage.set(key, ledger)
+        return count
+
+    def reset(self, chat_id: int, user_id: int):
+        key = self._key(chat_id)
+        ledger = self.storage.get(key, {})
+        if ledger.pop(str(user_id), None) is not None:
+            self.storage.set(key, ledger)
+
+warning_ledger = WarningLedger(db, SPAM_SETTINGS['warning_reset_time'])
+
+# Срок жизни пользовательских ключей антиспама
+EXPIRY_SETTINGS = {
+    'ttl': {
+        'recent_texts_': 7 * 24 * 3600,
+        'recent_media_': 24 * 3600,
+    },
+    'sweep_interval': 60,
+    'slice_budget': 0.003,
+}
+
+class ExpiryIndex:
+    """Время последнего обращения к ключам recent_texts_/recent_media_.
+
+    Индекс держится в памяти и пишется в шард users_N под ключом expiry_N
+    только при периодическом сбросе базы, поэтому сообщение обходится без
+    лишней записи. Очистка читает шард в отдельном потоке и удаляет ключи
+    порциями не дольше slice_budget.
+    """
+
+    def __init__(self, storage, ttl: dict, slice_budget: float):
+        self.storage = storage
+        self.ttl = ttl
+        self.slice_budget = slice_budget
+        self._cursors = defaultdict(int)
+        self._indexes = {}
+        self._dirty = set()
+
+    def _index(self, bucket: int) -> dict:
+        scope = (storage_namespace.get(), bucket)
+        index = self._indexes.get(scope)
+        if index is None:
+            index = self._indexes[scope] = dict(self.storage.get(f"expiry_{bucket}", {}))
+        return index
+
+    def touch(self, key: str, now: float = None):
+        bucket = int(key[len(key_prefix(key)):]) % self.storage.user_buckets
+        self._index(bucket)[key] = now if now is not None else clock.time()
+        self._dirty.add((storage_namespace.get(), bucket))
+
+    def persist(self):
+        """Переносит изменившиеся индексы в их шарды (перед сбросом базы)"""
+        for namespace, bucket in list(self._dirty):
+            token = storage_namespace.set(namespace)
+            try:
+                self.storage.set(f"expiry_{bucket}", dict(self._indexes[namespace, bucket]))
+            finally:
+                storage_namespace.reset(token)
+        self._dirty.clear()
+
+    async def sweep_bucket(self, bucket: int, now: float = None) -> int:
+        """Удаляет просроченные ключи бакета порциями не дольше slice_budget между уступками циклу событий"""
+        now = now if now is not None else clock.time()
+        shard_id = f"users_{bucket}"
+        await self.storage.load_shard(shard_id)
+        index = self._index(bucket)
+        keys = [key for key in self.storage.shard_keys(shard_id) if key_prefix(key) in self.ttl]
+        removed = 0
+        changed = False
+        while keys:
+            # Между порциями шард могли выгрузить: читаем его снова вне цикла событий
+            if not self.storage.is_resident(shard_id):
+                await self.storage.load_shard(shard_id)
+            deadline = time.monotonic() + self.slice_budget
+            while keys and time.monotonic() < deadline:
+                key = keys.pop()
+                touched = index.get(key)
+                if touched is None:
+                    # Ключ из времён до индекса: отсчитываем срок с первого прохода
+                    if key in self.storage:
+                        index[key] = now
+                        changed = True
+                elif now - touched > self.ttl[key_prefix(key)]:
+                    self.storage.delete(key)
+                    del index[key]
+                    removed += 1
+                    changed = True
+            await asyncio.sleep(0)
+        if changed:
+            self._dirty.add((storage_namespace.get(), bucket))
+        return removed
+
+    async def sweep_next(self) -> int:
+        namespace = storage_namespace.get()
+        bucket = self._cursors[namespace]
+        self._cursors[namespace] = (bucket + 1) % self.storage.user_buckets
+        removed = await self.sweep_bucket(bucket)
+        if removed:
+            db_logger.info("Очистка устаревших ключей: шард users_%s, удалено %s", bucket, removed)
+        return removed
+
+expiry_index = ExpiryIndex(db, EXPIRY_SETTINGS['ttl'], EXPIRY_SETTINGS['slice_budget'])
+
+def normalize_text(text: str) -> str:
+    """Приводит текст к виду для сравнения: casefold, ё -> е, знаки препинания -> пробелы"""
+    text = text.casefold().replace('ё', 'е')
+    return ' '.join(''.join(char if char.isalnum() else ' ' for char in text).split())
+
+# Отпечатки спама, общие для всех ботов процесса
+FINGERPRINT_SETTINGS = {
+    'capacity': 50000,
+    'min_text_length': 20,
+    'min_chats': 2,
+    'max_chats_tracked': 16,
+    'ttl': 24 * 3600,
+}
+
+class SpamFingerprints:
+    """Отпечатки сообщений, уже признанных спамом: нормализованный текст или file_unique_id медиа.
+
+    Индекс один на процесс, поэтому рассылку, пойманную одним ботом в одном
+    чате, остальные боты узнают с первого сообщения.
+    """
+
+    def __init__(self, capacity: int, min_chats: int, max_chats_tracked: int, ttl: int):
+        self.capacity = capacity
+        self.min_chats = min_chats
+        self.max_chats_tracked = max_chats_tracked
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def of_text(text: str) -> Optional[str]:
+        normalized = normalize_text(text)
+        if len(normalized) < FINGERPRINT_SETTINGS['min_text_length']:
+            return None
+        return 't:' + hashlib.blake2b(normalized.encode('utf-8'), digest_size=8).hexdigest()
+
+    @staticmethod
+    def of_media(file_unique_id: Optional[str]) -> Optional[str]:
+        return f"m:{file_unique_id}" if file_unique_id else None
+
+    def flag(self, fingerprint: str, chat_id: int, now: float):
+        entry = self._entries.pop(fingerprint, None) or [set(), now]
+        if len(entry[0]) < self.max_chats_tracked:
+            entry[0].add(chat_scope(chat_id))
+        entry[1] = now
+        self._entries[fingerprint] = entry
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def is_known(self, fingerprint: str, chat_id: int, now: float) -> bool:
+        """Отпечаток уже помечен как спам в других чатах (этого или других ботов)"""
+        entry = self._entries.get(fingerprint)
+        if entry is None:
+            return False
+        if now - entry[1] > self.ttl:
+            del self._entries[fingerprint]
+            return False
+        return len(entry[0] - {chat_scope(chat_id)}) >= self.min_chats
+
+spam_fingerprints = SpamFingerprints(
+    FINGERPRINT_SETTINGS['capacity'],
+    FINGERPRINT_SETTINGS['min_chats'],
+    FINGERPRINT_SETTINGS['max_chats_tracked'],
+    FINGERPRINT_SETTINGS['ttl'],
+)
+
+# Запрещённые слова и фразы чата
+BANNED_WORDS_SETTINGS = {
+    'max_patterns': 5000,
+    'cache_size': 1000,
+}
+
+class KeywordAutomaton:
+    """Автомат Ахо — Корасик: все шаблоны ищутся за один проход по тексту.
+
+    Текст и шаблоны нормализуются normalize_text и обрамляются пробелами,
+    поэтому совпадают только целые слова; шаблон со звёздочкой на конце
+    («казино*») совпадает с любым словом, которое с него начинается.
+    """
+
+    def __init__(self, patterns):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        for pattern in patterns:
+            self._add(pattern)
+        self._link()
+
+    @staticmethod
+    def needle(pattern: str) -> str:
+        prefix = pattern.endswith('*')
+        normalized = normalize_text(pattern.rstrip('*'))
+        return f" {normalized}" if prefix else f" {normalized} "
+
+    def _add(self, pattern: str):
+        needle = self.needle(pattern)
+        if not needle.strip():
+            return
+        state = 0
+        for char in needle:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+        self._output[state] += (pattern,)
+
+    def _link(self):
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, next_state in self._goto[state].items():
+                pending.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] += self._output[self._fail[next_state]]
+
+    def search(self, text: str) -> Optional[str]:
+        """Возвращает первый найденный шаблон или None"""
+        state = 0
+        for char in f" {normalize_text(text)} ":
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            if self._output[state]:
+                return self._output[state][0]
+        return None
+
+banned_words_versions = defaultdict(int)
+banned_word_filters = OrderedDict()
+
+def get_banned_words(chat_id: int) -> list:
+    return db.get(f"banned_words_{chat_id}", [])
+
+def save_banned_words(chat_id: int, words: list):
+    """Сохраняет список запрещённых слов; автомат будет пересобран при следующей проверке"""
+    db.set(f"banned_words_{chat_id}", words)
+    banned_words_versions[chat_scope(chat_id)] += 1
+
+def find_banned_word(chat_id: int, text: str) -> Optional[str]:
+    """Ищет в тексте запрещённые слова чата; автомат пересобирается только после изменения списка"""
+    if not text:
+        return None
+
+    scope = chat_scope(chat_id)
+    version = banned_words_versions[scope]
+    cached = banned_word_filters.get(scope)
+    if cached is None or cached[0] != version:
+        words = get_banned_words(chat_id)
+        cached = (version, KeywordAutomaton(words) if words else None)
+        banned_word_filters[scope] = cached
+    banned_word_filters.move_to_end(scope)
+    while len(banned_word_filters) > BANNED_WORDS_SETTINGS['cache_size']:
+        banned_word_filters.popitem(last=False)
+
+    automaton = cached[1]
+    return automaton.search(text) if automaton else None
+
+# Фильтр ссылок
+LINK_SETTINGS = {
+    'rate_capacity': 10000,
+    'rate_window': 600,
+    'rate_chats': 5,
+    'throttle_duration': 3600,
+    # Домены, которые законно встречаются во многих чатах сразу
+    'trusted_domains': {'t.me', 'telegram.org', 'youtube.com', 'youtu.be', 'wikipedia.org', 'github.com', 'google.com'},
+}
+
+# Двухуровневые публичные суффиксы, под которыми регистрируют домены третьего уровня
+MULTI_LABEL_SUFFIXES = {
+    'co.uk', 'org.uk', 'com.ru', 'net.ru', 'org.ru', 'msk.ru', 'spb.ru', 'com.ua', 'kiev.ua', 'com.by',
+    'com.kz', 'co.jp', 'com.au', 'com.br', 'com.tr', 'co.il', 'co.in', 'com.cn',
+}
+
+def registrable_domain(url: str) -> Optional[str]:
+    """Регистрируемый домен ссылки: https://www.shop.example.co.uk/x -> example.co.uk"""
+    if '://' not in url:
+        url = f"//{url}"
+    try:
+        parts = urlsplit(url)
+        host = parts.hostname
+    except ValueError:
+        return None
+    if parts.scheme not in ('', 'http', 'https') or not host:
+        return None
+
+    labels = host.rstrip('.').split('.')
+    if len(labels) < 2:
+        return None
+    if all(label.isdigit() for label in labels):
+        return '.'.join(labels)
+    count = 3 if '.'.join(labels[-2:]) in MULTI_LABEL_SUFFIXES else 2
+    return '.'.join(labels[-count:])
+
+def message_domains(message) -> set:
+    """Домены из сущностей url и text_link сообщения и подписи (без разбора сырого текста)"""
+    link_types = [MessageEntity.URL, MessageEntity.TEXT_LINK]
+    entities = dict(message.parse_entities(link_types))
+    entities.update(message.parse_caption_entities(link_types))
+
+    domains = set()
+    for entity, text in entities.items():
+        domain = registrable_domain(entity.url if entity.type == MessageEntity.TEXT_LINK else text)
+        if domain:
+            domains.add(domain)
+    return domains
+
+class DomainRates:
+    """Сколько разных чатов за окно прислали ссылку на домен.
+
+    Ограниченный LRU, общий для всех чатов и ботов процесса: домен, который
+    внезапно появился во многих чатах, на время считается спамом.
+    """
+
+    def __init__(self, capacity: int, window: int, chats: int, throttle_duration: int):
+        self.capacity = capacity
+        self.window = window
+        self.chats = chats
+        self.throttle_duration = throttle_duration
+        self._entries = OrderedDict()
+
+    def observe(self, domain: str, chat_id: int, now: float) -> bool:
+        """Учитывает ссылку и возвращает True, если домен сейчас ограничен"""
+        entry = self._entries.pop(domain, None)
+        if entry is None or now - entry[0] > self.window:
+            entry = [now, set(), entry[2] if entry else 0]
+        if len(entry[1]) < self.chats:
+            entry[1].add(chat_scope(chat_id))
+        if len(entry[1]) >= self.chats and entry[2] <= now:
+            entry[2] = now + self.throttle_duration
+            spam_logger.warning("Домен %s появился в %s чатах за %s с, ссылки на него ограничены", domain, len(entry[1]), self.window)
+        self._entries[domain] = entry
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+        return entry[2] > now
+
+domain_rates = DomainRates(
+    LINK_SETTINGS['rate_capacity'],
+    LINK_SETTINGS['rate_window'],
+    LINK_SETTINGS['rate_chats'],
+    LINK_SETTINGS['throttle_duration'],
+)
+
+def get_link_rules(chat_id: int) -> dict:
+    return db.get(f"links_{chat_id}", {'allow': {}, 'deny': {}})
+
+def check_links(message, chat_id: int, now: float) -> Optional[str]:
+    """Возвращает причину предупреждения, если в сообщении есть запрещённая или массово рассылаемая ссылка"""
+    domains = message_domains(message)
+    if not domains:
+        return None
+
+    rules = get_link_rules(chat_id)
+    for domain in domains:
+        if domain in rules['allow'] or domain in LINK_SETTINGS['trusted_domains']:
+            continue
+        if domain in rules['deny']:
+            return f"запрещённая ссылка ({domain})"
+        if domain_rates.observe(domain, chat_id, now):
+            return f"ссылка на массово рассылаемый домен ({domain})"
+    return None
+
+# Журнал модерации
+AUDIT_SETTINGS = {
+    'directory': 'audit_log',
+    'segment_size': 4 * 1024 * 1024,
+}
+
+class AuditLog:
+    """Журнал модерации: JSONL-сегменты с ротацией по размеру и индексом (чат, пользователь) -> смещения.
+
+    Запись идёт в отдельном потоке, обработчики только кладут событие в очередь.
+    Каталог, индекс и поток появляются при start() (из build_application или
+    при первом обращении), поэтому export и snapshot журнал не открывают.
+    """
+
+    def __init__(self, directory: str, segment_size: int):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._index = defaultdict(list)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        """Загружает индекс и запускает поток записи; повторные вызовы ничего не делают"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            started = time.monotonic()
+            self._load_index()
+            startup_stats['audit_index_seconds'] = time.monotonic() - started
+
+            self._thread = threading.Thread(target=self._writer, name='audit-log', daemon=True)
+            self._thread.start()
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"segment_{segment:06d}.jsonl")
+
+    def _index_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"segment_{segment:06d}.idx")
+
+    def _index_signature(self, segments) -> dict:
+        signature = {}
+        for segment in segments:
+            try:
+                signature[segment] = os.path.getsize(self._index_path(segment))
+            except FileNotFoundError:
+                signature[segment] = None
+        return signature
+
+    def _list_segments(self) -> list:
+        return sorted(
+            int(name[len('segment_'):-len('.jsonl')])
+            for name in os.listdir(self.directory)
+            if name.startswith('segment_') and name.endswith('.jsonl')
+        )
+
+    def _load_index(self):
+        segments = self._list_segments()
+        self._segment = segments[-1] if segments else 1
+        try:
+            self._segment_bytes = os.path.getsize(self._segment_path(self._segment))
+        except FileNotFoundError:
+            self._segment_bytes = 0
+
+        # Быстрый старт: индекс из бинарного файла, если .idx с тех пор не менялись
+        try:
+            with open(os.path.join(self.directory, 'index.warm'), 'rb') as f:
+                payload = pickle.load(f)
+            if payload.get('signature') == self._index_signature(segments):
+                self._index = defaultdict(list, payload['index'])
+                return
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            db_logger.warning("Бинарный индекс журнала модерации не прочитан: %s", e)
+
+        for segment in segments:
+            try:
+                with open(self._index_path(segment), 'r', encoding='utf-8') as f:
+                    for line in f:
+                        parts = line.split()
+                        if len(parts) != 3:
+                            continue
+                        chat_id, user_id, offset = map(int, parts)
+                        self._index[(chat_id, user_id)].append((segment, offset))
+            except FileNotFoundError:
+                pass
+
+    def record(self, action: str, chat_id: int, user_id: int, **fields):
+        """Ставит событие модерации в очередь на запись"""
+        event = {'ts': clock.time(), 'action': action, 'chat_id': chat_id, 'user_id': user_id}
+        event.update({key: value for key, value in fields.items() if value is not None})
+        if storage_namespace.get():
+            event['bot'] = storage_namespace.get()
+        self.start()
+        self._queue.put(event)
+
+    def _writer(self):
+        segment_file = index_file = None
+        while True:
+            event = self._queue.get()
+            if event is None:
+                break
+
+            line = (json.dumps(event, ensure_ascii=False) + '\n').encode('utf-8')
+            if segment_file is not None and self._segment_bytes and self._segment_bytes + len(line) > self.segment_size:
+                segment_file.close()
+                index_file.close()
+                segment_file = index_file = None
+                self._segment += 1
+                self._segment_bytes = 0
+            if segment_file is None:
+                segment_file = open(self._segment_path(self._segment), 'ab')
+                index_file = open(self._index_path(self._segment), 'a', encoding='utf-8')
+
+            offset = self._segment_bytes
+            segment_file.write(line)
+            index_file.write(f"{event['chat_id']} {event['user_id']} {offset}\n")
+            self._segment_bytes += len(line)
+
+            with self._lock:
+                self._index[(event['chat_id'], event['user_id'])].append((self._segment, offset))
+
+            if self._queue.empty():
+                segment_file.flush()
+                index_file.flush()
+
+        if segment_file is not None:
+            segment_file.close()
+            index_file.close()
+
+    def query(self, chat_id: int, user_id: int, limit: int = None) -> list:
+        """Возвращает события против пользователя в чате, начиная с самых новых (только текущего бота)"""
+        self.start()
+        with self._lock:
+            locations = list(self._index.get((chat_id, user_id), ()))
+        locations.reverse()
+        namespace = storage_namespace.get()
+
+        events = []
+        handles = {}
+        try:
+            for segment, offset in locations:
+                if limit is not None and len(events) >= limit:
+                    break
+                f = handles.get(segment)
+                if f is None:
+                    f = handles[segment] = open(self._segment_path(segment), 'rb')
+                f.seek(offset)
+                try:
+                    event = json.loads(f.readline())
+                except json.JSONDecodeError:
+                    continue
+                if event.get('bot', '') == namespace:
+                    events.append(event)
+        finally:
+            for f in handles.values():
+                f.close()
+        return events
+
+    def stats(self) -> dict:
+        """Оценка памяти индекса для /stats; индекс пополняется потоком записи, поэтому под замком"""
+        with self._lock:
+            return {'index_bytes': estimate_size(self._index), 'indexed_pairs': len(self._index)}
+
+    def write_warm_start(self):
+        """Сохраняет индекс в бинарном виде (после остановки потока записи)"""
+        payload = {'signature': self._index_signature(self._list_segments()), 'index': dict(self._index)}
+        path = os.path.join(self.directory, 'index.warm')
+        with open(f"{path}.tmp", 'wb') as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+        if not self._thread.is_alive():
+            self.write_warm_start()
+
+audit_log = AuditLog(AUDIT_SETTINGS['directory'], AUDIT_SETTINGS['segment_size'])
+atexit.register(audit_log.close)
+
 # Настройки наказаний по умолчанию
 DEFAULT_PUNISHMENT_SETTINGS = {
     'punishment_type': 'mute',
@@ -91,33 +1222,164 @@ def is_admin(user_id: int, chat_id: int) -> bool:
     admins = db.get(f"admins_{chat_id}", [])
     return user_id in admins
 
-def get_chat_settings(chat_id: int) -> dict:
-    """Получает настройки чата"""
-    default_settings = {
-        'antispam_enabled': True,
-        'auto_moderation': True,
-        'welcome_message': True,
-        'delete_service_messages': True,
-        'punishment_type': 'mute',
-        'mute_duration': 300,
-        'ban_duration': 3600,
-        'warnings_before_punishment': 3,
-        'ai_enabled': True,
-        'ai_response_chance': 25,
-        'rapid_messages_count': 5,
-    }
-    settings = db.get(f"settings_{chat_id}", default_settings)
-    for key, value in default_settings.items():
-        if key not in settings:
-            settings[key] = value
-    if 'rapid_messages_count' in SPAM_SETTINGS and SPAM_SETTINGS['rapid_messages_count'] != settings.get('rapid_messages_count'):
-        settings['rapid_messages_count'] = SPAM_SETTINGS['rapid_messages_count']
+DEFAULT_CHAT_SETTINGS = {
+    'antispam_enabled': True,
+    'auto_moderation': True,
+    'welcome_message': True,
+    'delete_service_messages': True,
+    'punishment_type': 'mute',
+    'mute_duration': 300,
+    'ban_duration': 3600,
+    'warnings_before_punishment': 3,
+    'ai_enabled': True,
+    'ai_response_chance': 25,
+    'rapid_messages_count': 5,
+    'link_filter': True,
+    'captcha_enabled': False,
+    'captcha_action': 'kick',
+    'captcha_timeout': 120,
+}
 
+# Шаблоны настроек: все шаблоны бота лежат одним ключом, чат хранит только имя шаблона и свои отличия
+templates_versions = defaultdict(int)
+
+def get_settings_templates() -> dict:
+    return db.get("settings_templates", {})
+
+def save_settings_templates(templates: dict):
+    """Одна запись обновляет все чаты, привязанные к шаблонам"""
+    db.set("settings_templates", templates)
+    templates_versions[storage_namespace.get()] += 1
+
+def inherited_settings(template: Optional[str]) -> dict:
+    """Значения по умолчанию, поверх которых наложен шаблон"""
+    settings = dict(DEFAULT_CHAT_SETTINGS)
+    if template:
+        settings.update(get_settings_templates().get(template, {}))
+    return settings
+
+def get_chat_settings(chat_id: int) -> dict:
+    """Получает настройки чата: значения по умолчанию, затем шаблон, затем собственные настройки чата"""
+    stored = db.get(f"settings_{chat_id}", {})
+    settings = inherited_settings(stored.get('template'))
+    settings.update(stored)
     return settings
 
 def save_chat_settings(chat_id: int, settings: dict):
-    """Сохраняет настройки чата"""
-    db.set(f"settings_{chat_id}", settings)
+    """Сохраняет настройки чата: только то, что отличается от унаследованного"""
+    template = settings.get('template')
+    inherited = inherited_settings(template)
+    own = {key: value for key, value in settings.items() if key != 'template' and inherited.get(key) != value}
+    if template:
+        own['template'] = template
+    db.set(f"settings_{chat_id}", own)
+    settings_versions[chat_scope(chat_id)] += 1
+
+def settings_version(chat_id: int) -> tuple:
+    """Версия итоговых настроек чата: меняется и при правке чата, и при правке шаблонов"""
+    return settings_versions[chat_scope(chat_id)], templates_versions[storage_namespace.get()]
+
+# Догоняние после простоя: накопившиеся апдейты проходят только проверку на спам
+CATCHUP_SETTINGS = {
+    'stale_after': int(os.environ.get('CATCHUP_STALE_AFTER', 60)),
+    # Разбор считается законченным, если устаревших апдейтов нет столько секунд
+    'idle_timeout': 5,
+}
+
+class CatchUp:
+    """Разбор апдейтов, накопившихся за время простоя.
+
+    Апдейт устарел, если сообщение или вступление старше stale_after секунд.
+    Апдейты без даты (нажатия кнопок и т.п.) на режим не влияют. Устаревшие
+    сообщения проходят антиспам и команды, но сам бот на них не отвечает;
+    нарушения молча копятся в предупреждениях, и наказание из настроек чата
+    применяется к каждому нарушителю не больше одного раза за разбор. Разбор заканчивается первым свежим
+    апдейтом или тишиной в idle_timeout секунд; его время пишется в лог и в /stats.
+    """
+
+    def __init__(self, stale_after: int, idle_timeout: float):
+        self.stale_after = stale_after
+        self.idle_timeout = idle_timeout
+        self.started = None
+        self.last = None
+        self.oldest_age = 0
+        self.updates = 0
+        self.skipped = 0
+        self.enforced = set()
+        self.last_drain = None
+
+    @staticmethod
+    def event_date(update) -> Optional[datetime]:
+        """Когда произошло событие апдейта; None, если апдейт не несёт своей даты"""
+        if update.callback_query:
+            # effective_message у кнопки - сообщение бота, его дата ничего не говорит о нажатии
+            return None
+        message = update.effective_message
+        if message is not None:
+            return message.edit_date or message.date
+        member = update.chat_member or update.my_chat_member
+        return member.date if member is not None else None
+
+    def age(self, update) -> Optional[float]:
+        date = self.event_date(update)
+        return clock.time() - date.timestamp() if date else None
+
+    def is_stale(self, update) -> bool:
+        age = self.age(update)
+        return age is not None and age > self.stale_after
+
+    def event_time(self, update) -> float:
+        """Время для окон антиспама: у устаревших апдейтов это время отправки, а не разбора"""
+        if self.is_stale(update):
+            return self.event_date(update).timestamp()
+        return clock.time()
+
+    def observe(self, update):
+        age = self.age(update)
+        if age is None:
+            return
+        if age > self.stale_after:
+            if self.started is None:
+                self.started = time.monotonic()
+                self.updates = self.skipped = 0
+                self.oldest_age = age
+                self.enforced.clear()
+                logger.warning("Получены апдейты %.0f с давности: режим догоняния, ответы отключены", age)
+            self.updates += 1
+            self.last = time.monotonic()
+        elif self.started is not None:
+            self.finish()
+
+    def finish(self):
+        self.last_drain = {
+            'seconds': round(self.last - self.started, 3),
+            'updates': self.updates,
+            'skipped_replies': self.skipped,
+            'enforced_users': len(self.enforced),
+            'oldest_age_seconds': round(self.oldest_age),
+        }
+        self.started = None
+        logger.info(
+            "Догоняние завершено за %.1f с: апдейтов %s, пропущено ответов %s, наказано пользователей %s",
+            self.last_drain['seconds'], self.updates, self.skipped, len(self.enforced)
+        )
+
+    def check_idle(self):
+        """Заканчивает разбор, если устаревшие апдейты перестали приходить"""
+        if self.started is not None and time.monotonic() - self.last >= self.idle_timeout:
+            self.finish()
+
+    def was_punished(self, chat_id: int, user_id: int) -> bool:
+        """Наказан ли пользователь в чате за текущий разбор"""
+        return (*chat_scope(chat_id), user_id) in self.enforced
+
+    def mark_punished(self, chat_id: int, user_id: int):
+        self.enforced.add((*chat_scope(chat_id), user_id))
+
+    def stats(self) -> dict:
+        return {'active': self.started is not None, 'stale_after': self.stale_after, 'last_drain': self.last_drain}
+
+catch_up = CatchUp(CATCHUP_SETTINGS['stale_after'], CATCHUP_SETTINGS['idle_timeout'])
 
 async def check_spam(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Проверяет сообщение на спам"""
@@ -127,13 +1389,14 @@ async def check_spam(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool
     user_id = update.message.from_user.id
     chat_id = update.message.chat_id
     message_text = update.message.text or ""
-    current_time = time.time()
+    current_time = catch_up.event_time(update)
 
     settings = get_chat_settings(chat_id)
     if not settings.get('antispam_enabled', True):
         return False
 
-    user_history = user_message_history[user_id]
+    # История у каждого бота своя: два бота в одном чате не должны делить счётчик флуда
+    user_history = user_message_history[(storage_namespace.get(), user_id)]
     user_history.append(current_time)
 
     recent_messages = [t for t in user_history if current_time - t < SPAM_SETTINGS['rapid_messages_time']]
@@ -143,14 +1406,33 @@ async def check_spam(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool
         await warn_user(update, context, "слишком частые сообщения")
         return True
 
+    banned_word = find_banned_word(chat_id, message_text or update.message.caption or "")
+    if banned_word:
+        await warn_user(update, context, f"запрещённое слово «{banned_word}»")
+        return True
+
+    if settings.get('link_filter', True):
+        link_reason = check_links(update.message, chat_id, current_time)
+        if link_reason:
+            await warn_user(update, context, link_reason)
+            return True
+
     if message_text:
+        fingerprint = SpamFingerprints.of_text(message_text)
+        if fingerprint and spam_fingerprints.is_known(fingerprint, chat_id, current_time):
+            await warn_user(update, context, "рассылка, замеченная в других чатах")
+            return True
+
         recent_texts = db.get(f"recent_texts_{user_id}", [])
         recent_texts.append(message_text)
         recent_texts = recent_texts[-10:]
         db.set(f"recent_texts_{user_id}", recent_texts)
+        expiry_index.touch(f"recent_texts_{user_id}", current_time)
 
         identical_count = recent_texts.count(message_text)
         if identical_count >= SPAM_SETTINGS['max_identical_messages']:
+            if fingerprint:
+                spam_fingerprints.flag(fingerprint, chat_id, current_time)
             await warn_user(update, context, "повторяющиеся сообщения")
             return True
 
@@ -166,7 +1448,7 @@ async def check_spam(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool
     elif update.message.animation:
         media_type = "gif"
         media_id = update.message.animation.file_id
-        logger.info(f"Обнаружена GIF от пользователя {user_id}: {media_id}")
+        spam_logger.info("Обнаружена GIF от пользователя %s: %s", user_id, media_id)
     elif update.message.video:
         media_type = "video"
         media_id = update.message.video.file_id
@@ -184,6 +1466,14 @@ async def check_spam(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool
         media_id = update.message.audio.file_id
 
     if media_type and media_id:
+        attachment = update.message.effective_attachment
+        if isinstance(attachment, (list, tuple)):
+            attachment = attachment[-1]
+        media_fingerprint = SpamFingerprints.of_media(getattr(attachment, 'file_unique_id', None))
+        if media_fingerprint and spam_fingerprints.is_known(media_fingerprint, chat_id, current_time):
+            await warn_user(update, context, f"{media_type} из рассылки, замеченной в других чатах")
+            return True
+
         recent_media = db.get(f"recent_media_{user_id}", [])
         recent_media.append({"type": media_type, "id": media_id, "time": current_time})
 
@@ -192,6 +1482,7 @@ async def check_spam(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool
             if current_time - item.get("time", 0) < 3600
         ]
         db.set(f"recent_media_{user_id}", recent_media)
+        expiry_index.touch(f"recent_media_{user_id}", current_time)
 
         identical_media = [
             item for item in recent_media
@@ -199,6 +1490,8 @@ async def check_spam(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool
         ]
 
         if len(identical_media) >= SPAM_SETTINGS['max_identical_messages']:
+            if media_fingerprint:
+                spam_fingerprints.flag(media_fingerprint, chat_id, current_time)
             await warn_user(update, context, f"повторяющиеся {media_type}")
             return True
 
@@ -221,15 +1514,27 @@ async def warn_user(update: Update, context: ContextTypes.DEFAULT_TYPE, reason:
     chat_id = update.message.chat_id
     username = update.message.from_user.username or update.message.from_user.first_name
 
+    # При догонянии предупреждения копятся молча; после наказания за этот разбор
+    # остальные сообщения нарушителя просто удаляются
+    stale = catch_up.is_stale(update)
+    if stale and catch_up.was_punished(chat_id, user_id):
+        try:
+            await update.message.delete()
+        except Exception as e:
+            spam_logger.error("Ошибка при удалении устаревшего спама: %s", e)
+        return
+
     settings = get_chat_settings(chat_id)
     punishment_type = settings.get('punishment_type', 'mute')
     warnings_limit = settings.get('warnings_before_punishment', 3)
 
-    user_warnings[user_id] += 1
-    warnings_count = user_warnings[user_id]
+    warnings_count = warning_ledger.add(chat_id, user_id)
+    audit_log.record('warn', chat_id, user_id, reason=reason, count=warnings_count)
 
     if warnings_count >= warnings_limit:
-        user_warnings[user_id] = 0
+        warning_ledger.reset(chat_id, user_id)
+        if stale:
+            catch_up.mark_punished(chat_id, user_id)
 
         if punishment_type == 'mute':
             duration = settings.get('mute_duration', 300)
@@ -246,13 +1551,11 @@ async def warn_user(update: Update, context: ContextTypes.DEFAULT_TYPE, reason:
 
             try:
                 await update.message.delete()
-                warning_msg = await context.bot.send_message(chat_id, warning_text, parse_mode='Markdown')
-                context.job_queue.run_once(
-                    lambda context: context.bot.delete_message(chat_id, warning_msg.message_id),
-                    60
-                )
+                if not stale:
+                    warning_msg = await context.bot.send_message(chat_id, warning_text, parse_mode='Markdown')
+                    clock.run_once(context.job_queue, delete_messages_job, 60, data=(chat_id, [warning_msg.message_id]))
             except Exception as e:
-                logger.error(f"Ошибка при выдаче финального предупреждения: {e}")
+                spam_logger.error("Ошибка при выдаче финального предупреждения: %s", e)
     else:
         punishment_name = {
             'mute': 'мут',
@@ -269,14 +1572,11 @@ async def warn_user(update: Update, context: ContextTypes.DEFAULT_TYPE, reason:
 
         try:
             await update.message.delete()
-            warning_msg = await context.bot.send_message(chat_id, warning_text)
-
-            context.job_queue.run_once(
-                lambda context: context.bot.delete_message(chat_id, warning_msg.message_id),
-                30
-            )
+            if not stale:
+                warning_msg = await context.bot.send_message(chat_id, warning_text)
+                clock.run_once(context.job_queue, delete_messages_job, 30, data=(chat_id, [warning_msg.message_id]))
         except Exception as e:
-            logger.error(f"Ошибка при выдаче предупреждения: {e}")
+            spam_logger.error("Ошибка при выдаче предупреждения: %s", e)
 
 async def ban_user_spam(update: Update, context: ContextTypes.DEFAULT_TYPE, duration: int, reason: str = ""):
     """Банит пользователя на указанное время (для антиспама)"""
@@ -288,13 +1588,14 @@ async def ban_user_spam(update: Update, context: ContextTypes.DEFAULT_TYPE, dura
         return
 
     try:
-        until_date = datetime.now() + timedelta(seconds=duration)
+        until_date = clock.now() + timedelta(seconds=duration)
 
         await context.bot.ban_chat_member(
             chat_id=chat_id,
             user_id=user_id,
             until_date=until_date
         )
+        audit_log.record('ban', chat_id, user_id, duration=duration, reason=reason)
 
         if duration < 60:
             time_str = f"{duration} секунд"
@@ -308,15 +1609,12 @@ async def ban_user_spam(update: Update, context: ContextTypes.DEFAULT_TYPE, dura
             f"Причина: {reason}" if reason else f"🚫 Пользователь @{username} забанен на {time_str}"
         )
 
-        ban_msg = await context.bot.send_message(chat_id, ban_text)
-
-        context.job_queue.run_once(
-            lambda context: context.bot.delete_message(chat_id, ban_msg.message_id),
-            60
-        )
+        if not catch_up.is_stale(update):
+            ban_msg = await context.bot.send_message(chat_id, ban_text)
+            clock.run_once(context.job_queue, delete_messages_job, 60, data=(chat_id, [ban_msg.message_id]))
 
     except Exception as e:
-        logger.error(f"Ошибка при бане пользователя: {e}")
+        spam_logger.error("Ошибка при бане пользователя: %s", e)
         await context.bot.send_message(chat_id, f"❌ Не удалось забанить пользователя: {e}")
 
 async def mute_user(update: Update, context: ContextTypes.DEFAULT_TYPE, duration: int, reason: str = ""):
@@ -330,7 +1628,7 @@ async def mute_user(update: Update, context: ContextTypes.DEFAULT_TYPE, duration
 
     try:
         permissions = ChatPermissions(can_send_messages=False)
-        until_date = datetime.now() + timedelta(seconds=duration)
+        until_date = clock.now() + timedelta(seconds=duration)
 
         await context.bot.restrict_chat_member(
             chat_id=chat_id,
@@ -338,6 +1636,7 @@ async def mute_user(update: Update, context: ContextTypes.DEFAULT_TYPE, duration
             permissions=permissions,
             until_date=until_date
         )
+        audit_log.record('mute', chat_id, user_id, duration=duration, reason=reason)
 
         if duration < 60:
             time_str = f"{duration} секунд"
@@ -351,24 +1650,45 @@ async def mute_user(update: Update, context: ContextTypes.DEFAULT_TYPE, duration
             f"Причина: {reason}" if reason else f"🔇 Пользователь @{username} замучен на {time_str}"
         )
 
-        mute_msg = await context.bot.send_message(chat_id, mute_text)
-
-        context.job_queue.run_once(
-            lambda context: context.bot.delete_message(chat_id, mute_msg.message_id),
-            60
-        )
+        if not catch_up.is_stale(update):
+            mute_msg = await context.bot.send_message(chat_id, mute_text)
+            clock.run_once(context.job_queue, delete_messages_job, 60, data=(chat_id, [mute_msg.message_id]))
 
-        context.job_queue.run_once(
-            lambda context: unmute_user_job(context, chat_id, user_id),
-            duration
-        )
+        schedule_unmute(context.job_queue, chat_id, user_id, duration)
 
     except Exception as e:
-        logger.error(f"Ошибка при муте пользователя: {e}")
+        spam_logger.error("Ошибка при муте пользователя: %s", e)
         await context.bot.send_message(chat_id, f"❌ Не удалось замутить пользователя: {e}")
 
+def schedule_unmute(job_queue, chat_id: int, user_id: int, duration: float):
+    """Планирует размут и запоминает его, чтобы таймер пережил перезапуск и попал в снимки"""
+    pending = db.get("pending_unmutes", {})
+    pending[f"{chat_id}:{user_id}"] = clock.time() + duration
+    db.set("pending_unmutes", pending)
+
+    clock.run_once(
+        job_queue,
+        lambda context: unmute_user_job(context, chat_id, user_id),
+        duration
+    )
+
+def restore_pending_unmutes(job_queue):
+    """Заново планирует размуты, сохранённые до перезапуска"""
+    now = clock.time()
+    for key, until in db.get("pending_unmutes", {}).items():
+        chat_id, user_id = map(int, key.split(':'))
+        clock.run_once(
+            job_queue,
+            lambda context, chat_id=chat_id, user_id=user_id: unmute_user_job(context, chat_id, user_id),
+            max(0, until - now)
+        )
+
 async def unmute_user_job(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int):
     """Размучивает пользователя (для job queue)"""
+    pending = db.get("pending_unmutes", {})
+    if pending.pop(f"{chat_id}:{user_id}", None) is not None:
+        db.set("pending_unmutes", pending)
+
     try:
         permissions = ChatPermissions(
             can_send_messages=True,
@@ -383,7 +1703,7 @@ async def unmute_user_job(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user
             permissions=permissions
         )
     except Exception as e:
-        logger.error(f"Ошибка при автоматическом размуте: {e}")
+        spam_logger.error("Ошибка при автоматическом размуте: %s", e)
 
 async def get_smart_ai_response(message_text: str, user_id: int = None, chat_id: int = None) -> str:
     """🤖 Простой ИИ - повторяет только слова участников и составляет из них предложения"""
@@ -444,6 +1764,332 @@ def parse_time(time_str: str) -> int:
     except:
         return 300
 
+# Очистка сообщений (/purge)
+PURGE_SETTINGS = {
+    'history_size': 500,
+    'max_count': 500,
+    'batch_size': 100,
+    'min_interval': 0.1,
+}
+
+recent_chat_messages = defaultdict(lambda: deque(maxlen=PURGE_SETTINGS['history_size']))
+
+def remember_message(chat_id: int, message_id: int, user_id: int):
+    """Запоминает сообщение в кольце последних сообщений чата"""
+    recent_chat_messages[chat_scope(chat_id)].append((message_id, user_id))
+
+def select_purge_ids(chat_id: int, since_id: int = None, user_id: int = None, limit: int = None) -> list:
+    """Выбирает id сообщений для удаления, начиная с самых новых"""
+    selected = []
+    for message_id, sender_id in reversed(recent_chat_messages[chat_scope(chat_id)]):
+        if since_id is not None and message_id < since_id:
+            break
+        if user_id is not None and sender_id != user_id:
+            continue
+        selected.append(message_id)
+        if limit is not None and len(selected) >= limit:
+            break
+    return selected
+
+def forget_messages(chat_id: int, message_ids):
+    """Убирает удалённые сообщения из кольца"""
+    removed = set(message_ids)
+    ring = recent_chat_messages[chat_scope(chat_id)]
+    kept = [item for item in ring if item[0] not in removed]
+    ring.clear()
+    ring.extend(kept)
+
+class DeletionQueue:
+    """Очередь удаления сообщений пачками через deleteMessages с учётом лимитов Telegram"""
+
+    def __init__(self, batch_size: int, min_interval: float):
+        self.batch_size = batch_size
+        self.min_interval = min_interval
+        self._queue = None
+        self._worker = None
+
+    def submit(self, bot, chat_id: int, message_ids: list):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        message_ids = sorted(set(message_ids))
+        for start in range(0, len(message_ids), self.batch_size):
+            self._queue.put_nowait((bot, chat_id, message_ids[start:start + self.batch_size]))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while not self._queue.empty():
+            bot, chat_id, batch = self._queue.get_nowait()
+            await self._delete_batch(bot, chat_id, batch)
+            await asyncio.sleep(self.min_interval)
+
+    async def _delete_batch(self, bot, chat_id: int, batch: list):
+        while True:
+            try:
+                if hasattr(bot, 'delete_messages'):
+                    await bot.delete_messages(chat_id, batch)
+                else:
+                    # В python-telegram-bot 20.3 ещё нет обёртки для deleteMessages
+                    await bot._post('deleteMessages', {'chat_id': chat_id, 'message_ids': batch})
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                transport_logger.error("Ошибка при пакетном удалении сообщений: %s", e)
+                return
+
+    def drain(self) -> list:
+        """Забирает ещё не отправленные пачки (при остановке процесса)"""
+        pending = []
+        while self._queue is not None and not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        return pending
+
+deletion_queue = DeletionQueue(PURGE_SETTINGS['batch_size'], PURGE_SETTINGS['min_interval'])
+
+async def delete_messages_job(context: ContextTypes.DEFAULT_TYPE):
+    """Отложенное удаление сообщений бота (для job queue)"""
+    chat_id, message_ids = context.job.data
+    deletion_queue.submit(context.bot, chat_id, message_ids)
+
+# Справочник username -> пользователь, наполняется из всех апдейтов чата
+USER_DIRECTORY_SETTINGS = {
+    'max_per_chat': 5000,
+    'touch_interval': 3600,
+}
+
+USERNAME_NOT_FOUND_TEXT = (
+    "❌ Пользователь {username} ещё не встречался боту в этом чате.\n"
+    "Ответьте на его сообщение, чтобы применить команду."
+)
+
+KnownUser = namedtuple('KnownUser', ['id', 'username', 'first_name'])
+
+def remember_user(chat_id: int, user):
+    """Запоминает username пользователя в справочнике чата"""
+    if not user or not user.username:
+        return
+
+    key = f"usernames_{chat_id}"
+    directory = db.get(key, {})
+    name = user.username.lower()
+    now = clock.time()
+
+    entry = directory.get(name)
+    if (entry and entry[0] == user.id and entry[1] == user.first_name
+            and now - entry[2] < USER_DIRECTORY_SETTINGS['touch_interval']):
+        return
+
+    # Переставляем в конец: порядок словаря служит очередью LRU
+    directory.pop(name, None)
+    directory[name] = [user.id, user.first_name, now]
+    while len(directory) > USER_DIRECTORY_SETTINGS['max_per_chat']:
+        directory.pop(next(iter(directory)))
+    db.set(key, directory)
+
+def find_user_by_username(chat_id: int, username: str) -> Optional[KnownUser]:
+    """Ищет пользователя по @username среди встреченных в чате"""
+    username = username.lstrip('@')
+    entry = db.get(f"usernames_{chat_id}", {}).get(username.lower())
+    if entry is None:
+        return None
+    return KnownUser(entry[0], username, entry[1])
+
+# Статистика активности чатов: несколько КБ на чат независимо от числа участников
+ANALYTICS_SETTINGS = {
+    'hll_precision': 9,
+    'cms_width': 128,
+    'cms_depth': 4,
+    'top_size': 10,
+    'hours': 7 * 24,
+    'days': 7,
+    'cache_size': 2000,
+    'persist_interval': 300,
+}
+
+def _hash64(value: int, salt: bytes = b'') -> int:
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8, salt=salt).digest(), 'little')
+
+class HyperLogLog:
+    """Оценка числа уникальных значений в 2**precision байтах (ошибка около 1.04 / sqrt(2**precision))"""
+
+    def __init__(self, precision: int, registers: bytearray = None):
+        self.precision = precision
+        self.registers = registers if registers is not None else bytearray(1 << precision)
+
+    def add(self, hashed: int):
+        index = hashed & ((1 << self.precision) - 1)
+        rest = hashed >> self.precision
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: 'HyperLogLog'):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+class CountMinSketch:
+    """Частоты с оценкой сверху: depth строк по width счётчиков"""
+
+    def __init__(self, width: int, depth: int, counters: array.array = None):
+        self.width = width
+        self.depth = depth
+        self.counters = counters if counters is not None else array.array('I', bytes(4 * width * depth))
+
+    def add(self, value: int) -> int:
+        """Увеличивает счётчик значения и возвращает новую оценку"""
+        estimate = None
+        for row in range(self.depth):
+            i = row * self.width + _hash64(value, salt=bytes([row])) % self.width
+            self.counters[i] += 1
+            estimate = self.counters[i] if estimate is None else min(estimate, self.counters[i])
+        return estimate
+
+class ChatAnalytics:
+    """Сообщения по часам за неделю, уникальные авторы по дням и частые авторы текущей недели"""
+
+    def __init__(self):
+        settings = ANALYTICS_SETTINGS
+        self.hour = 0
+        self.hours = array.array('I', bytes(4 * settings['hours']))
+        self.day = 0
+        self.days = [HyperLogLog(settings['hll_precision']) for _ in range(settings['days'])]
+        self.week = 0
+        self.sketch = CountMinSketch(settings['cms_width'], settings['cms_depth'])
+        self.top = {}
+
+    def _roll(self, now: float):
+        hour = int(now // 3600)
+        for h in range(max(self.hour + 1, hour - len(self.hours) + 1), hour + 1):
+            self.hours[h % len(self.hours)] = 0
+        self.hour = max(self.hour, hour)
+
+        day = int(now // 86400)
+        for d in range(max(self.day + 1, day - len(self.days) + 1), day + 1):
+            self.days[d % len(self.days)] = HyperLogLog(ANALYTICS_SETTINGS['hll_precision'])
+        self.day = max(self.day, day)
+
+        # Неделя с понедельника (1 января 1970 года был четверг)
+        week = int((now + 3 * 86400) // (7 * 86400))
+        if week != self.week:
+            self.week = week
+            self.sketch = CountMinSketch(ANALYTICS_SETTINGS['cms_width'], ANALYTICS_SETTINGS['cms_depth'])
+            self.top = {}
+
+    def record(self, user_id: int, name: str, now: float):
+        self._roll(now)
+        self.hours[self.hour % len(self.hours)] += 1
+        self.days[self.day % len(self.days)].add(_hash64(user_id))
+
+        estimate = self.sketch.add(user_id)
+        key = str(user_id)
+        if key in self.top or len(self.top) < ANALYTICS_SETTINGS['top_size']:
+            self.top[key] = [estimate, name]
+            return
+        weakest = min(self.top, key=lambda uid: self.top[uid][0])
+        if estimate > self.top[weakest][0]:
+            del self.top[weakest]
+            self.top[key] = [estimate, name]
+
+    def messages(self, hours: int, now: float) -> int:
+        self._roll(now)
+        return sum(self.hours[h % len(self.hours)] for h in range(self.hour - hours + 1, self.hour + 1))
+
+    def unique_users(self, days: int, now: float) -> int:
+        self._roll(now)
+        merged = HyperLogLog(ANALYTICS_SETTINGS['hll_precision'])
+        for d in range(self.day - days + 1, self.day + 1):
+            merged.merge(self.days[d % len(self.days)])
+        return merged.count()
+
+    def top_posters(self) -> list:
+        return sorted(self.top.values(), key=lambda entry: entry[0], reverse=True)
+
+    def to_json(self) -> dict:
+        return {
+            'hour': self.hour,
+            'hours': base64.b64encode(self.hours.tobytes()).decode('ascii'),
+            'day': self.day,
+            'days': base64.b64encode(b''.join(bytes(hll.registers) for hll in self.days)).decode('ascii'),
+            'week': self.week,
+            'sketch': base64.b64encode(self.sketch.counters.tobytes()).decode('ascii'),
+            'top': self.top,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'ChatAnalytics':
+        analytics = cls()
+        try:
+            hours = array.array('I')
+            hours.frombytes(base64.b64decode(data['hours']))
+            counters = array.array('I')
+            counters.frombytes(base64.b64decode(data['sketch']))
+            registers = base64.b64decode(data['days'])
+        except (KeyError, ValueError) as e:
+            db_logger.warning("Статистика чата повреждена и начата заново: %s", e)
+            return analytics
+
+        size = 1 << ANALYTICS_SETTINGS['hll_precision']
+        if (len(hours) != len(analytics.hours) or len(counters) != len(analytics.sketch.counters)
+                or len(registers) != size * len(analytics.days)):
+            # Размеры изменились в настройках: старые данные несовместимы
+            return analytics
+
+        analytics.hour, analytics.hours = data['hour'], hours
+        analytics.day = data['day']
+        analytics.days = [HyperLogLog(ANALYTICS_SETTINGS['hll_precision'], bytearray(registers[i:i + size]))
+                          for i in range(0, len(registers), size)]
+        analytics.week = data['week']
+        analytics.sketch.counters = counters
+        analytics.top = data['top']
+        return analytics
+
+chat_analytics = OrderedDict()
+dirty_analytics = set()
+
+def _persist_analytics(scope: tuple, analytics: ChatAnalytics):
+    # Чат мог принадлежать другому боту: пишем в его пространство имён
+    token = storage_namespace.set(scope[0])
+    try:
+        db.set(f"analytics_{scope[1]}", analytics.to_json())
+    finally:
+        storage_namespace.reset(token)
+
+def get_chat_analytics(chat_id: int) -> ChatAnalytics:
+    """Статистика чата из кэша; при вытеснении из кэша изменения сохраняются в базу"""
+    scope = chat_scope(chat_id)
+    analytics = chat_analytics.get(scope)
+    if analytics is None:
+        data = db.get(f"analytics_{chat_id}")
+        analytics = ChatAnalytics.from_json(data) if data else ChatAnalytics()
+        chat_analytics[scope] = analytics
+        while len(chat_analytics) > ANALYTICS_SETTINGS['cache_size']:
+            evicted_scope, evicted = chat_analytics.popitem(last=False)
+            if evicted_scope in dirty_analytics:
+                dirty_analytics.discard(evicted_scope)
+                _persist_analytics(evicted_scope, evicted)
+    chat_analytics.move_to_end(scope)
+    return analytics
+
+def record_activity(chat_id: int, user, now: float):
+    get_chat_analytics(chat_id).record(user.id, user.first_name, now)
+    dirty_analytics.add(chat_scope(chat_id))
+
+def persist_analytics():
+    """Сохраняет в базу статистику всех изменившихся чатов"""
+    for scope in list(dirty_analytics):
+        analytics = chat_analytics.get(scope)
+        if analytics is not None:
+            _persist_analytics(scope, analytics)
+    dirty_analytics.clear()
+
 # Обработчики команд
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -463,6 +2109,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /unmute [@user или reply] - Размутить пользователя
 /ban [@user или reply] [время] - Забанить пользователя
 /unban [@user] - Разбанить пользователя
+/purge [N или since id] - Удалить сообщения (в ответ на сообщение)
+/audit - История модерации пользователя (в ответ на сообщение)
+/banwords [add|del|clear] - Запрещённые слова и фразы
+/links [allow|deny|remove домен] - Фильтр ссылок
+/chatstats - Активность чата
+/template [use имя|off] - Шаблон настроек
 /settings - Настройки чата
 /rules [текст] - Показать или установить правила
 /ai - Настройки ИИ
@@ -519,7 +2171,7 @@ async def mute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
     except Exception as e:
-        logger.error(f"Ошибка при проверке прав администратора для /mute: {e}")
+        logger.error("Ошибка при проверке прав администратора для /mute: %s", e)
         await update.message.reply_text("❌ Ошибка при проверке прав доступа!")
         return
 
@@ -531,11 +2183,13 @@ async def mute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if context.args and len(context.args) > 0:
             duration = parse_time(context.args[0])
 
-    elif context.args and len(context.args) >= 2 and context.args[0].startswith('@'):
-        username = context.args[0][1:]
-        duration = parse_time(context.args[1])
-        await update.message.reply_text("❌ Поиск по username пока не поддерживается. Пожалуйста, ответьте на сообщение пользователя.")
-        return
+    elif context.args and context.args[0].startswith('@'):
+        target_user = find_user_by_username(chat_id, context.args[0])
+        if not target_user:
+            await update.message.reply_text(USERNAME_NOT_FOUND_TEXT.format(username=context.args[0]))
+            return
+        if len(context.args) > 1:
+            duration = parse_time(context.args[1])
 
     elif context.args and len(context.args) == 1:
         await update.message.reply_text(
@@ -551,6 +2205,7 @@ async def mute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
             "❌ Использование команды `/mute`:\n"
             "• Ответьте на сообщение пользователя и напишите `/mute [время]`\n"
+            "• Или укажите username: `/mute @user [время]`\n"
             "• Примеры: `/mute` (5 минут), `/mute 30м`, `/mute 2ч`, `/mute 1д`\n"
             "• Форматы: с/s (секунды), м/m (минуты), ч/h (часы), д/d (дни)"
         )
@@ -563,11 +2218,11 @@ async def mute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Нельзя замутить администратора или владельца чата!")
                 return
         except Exception as e:
-            logger.error(f"Ошибка при проверке статуса пользователя: {e}")
+            logger.error("Ошибка при проверке статуса пользователя: %s", e)
 
         try:
             permissions = ChatPermissions(can_send_messages=False)
-            until_date = datetime.now() + timedelta(seconds=duration)
+            until_date = clock.now() + timedelta(seconds=duration)
 
             await context.bot.restrict_chat_member(
                 chat_id=chat_id,
@@ -575,6 +2230,7 @@ async def mute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 permissions=permissions,
                 until_date=until_date
             )
+            audit_log.record('mute', chat_id, target_user.id, duration=duration, reason="Ручная команда администратора", actor_id=user_id)
 
             if duration < 60:
                 time_str = f"{duration} секунд"
@@ -598,13 +2254,10 @@ async def mute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             await context.bot.send_message(chat_id, mute_text)
 
-            context.job_queue.run_once(
-                lambda context: unmute_user_job(context, chat_id, target_user.id),
-                duration
-            )
+            schedule_unmute(context.job_queue, chat_id, target_user.id, duration)
 
         except Exception as e:
-            logger.error(f"Ошибка при муте пользователя: {e}")
+            logger.error("Ошибка при муте пользователя: %s", e)
             await update.message.reply_text(f"❌ Не удалось замутить пользователя: {e}")
 
 async def unmute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -628,7 +2281,7 @@ async def unmute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
     except Exception as e:
-        logger.error(f"Ошибка при проверке прав администратора для /unmute: {e}")
+        logger.error("Ошибка при проверке прав администратора для /unmute: %s", e)
         await update.message.reply_text("❌ Ошибка при проверке прав доступа!")
         return
 
@@ -653,6 +2306,7 @@ async def unmute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_id=target_user.id,
             permissions=permissions
         )
+        audit_log.record('unmute', chat_id, target_user.id, reason="Ручная команда администратора", actor_id=user_id)
 
         username = target_user.username or target_user.first_name
         admin_name = update.message.from_user.username or update.message.from_user.first_name
@@ -667,7 +2321,7 @@ async def unmute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id, unmute_text)
 
     except Exception as e:
-        logger.error(f"Ошибка при размуте: {e}")
+        logger.error("Ошибка при размуте: %s", e)
         await update.message.reply_text(f"❌ Не удалось размутить пользователя: {e}")
 
 async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -691,39 +2345,48 @@ async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
     except Exception as e:
-        logger.error(f"Ошибка при проверке прав администратора для /ban: {e}")
+        logger.error("Ошибка при проверке прав администратора для /ban: %s", e)
         await update.message.reply_text("❌ Ошибка при проверке прав доступа!")
         return
 
     target_user = None
     duration = None
     duration_text = "навсегда"
+    duration_args = []
 
     if update.message.reply_to_message:
         target_user = update.message.reply_to_message.from_user
-        if context.args:
-            duration_seconds = parse_time(context.args[0])
-            duration = datetime.now() + timedelta(seconds=duration_seconds)
-
-            if duration_seconds < 60:
-                duration_text = f"{duration_seconds} секунд"
-            elif duration_seconds < 3600:
-                duration_text = f"{duration_seconds // 60} минут"
-            elif duration_seconds < 86400:
-                duration_text = f"{duration_seconds // 3600} часов"
-            else:
-                duration_text = f"{duration_seconds // 86400} дней"
+        duration_args = context.args or []
+    elif context.args and context.args[0].startswith('@'):
+        target_user = find_user_by_username(chat_id, context.args[0])
+        if not target_user:
+            await update.message.reply_text(USERNAME_NOT_FOUND_TEXT.format(username=context.args[0]))
+            return
+        duration_args = context.args[1:]
     else:
-        await update.message.reply_text("❌ Ответьте на сообщение пользователя для бана")
+        await update.message.reply_text("❌ Ответьте на сообщение пользователя или укажите @username для бана")
         return
 
+    if duration_args:
+        duration_seconds = parse_time(duration_args[0])
+        duration = clock.now() + timedelta(seconds=duration_seconds)
+
+        if duration_seconds < 60:
+            duration_text = f"{duration_seconds} секунд"
+        elif duration_seconds < 3600:
+            duration_text = f"{duration_seconds // 60} минут"
+        elif duration_seconds < 86400:
+            duration_text = f"{duration_seconds // 3600} часов"
+        else:
+            duration_text = f"{duration_seconds // 86400} дней"
+
     try:
         target_member = await context.bot.get_chat_member(chat_id, target_user.id)
         if target_member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
             await update.message.reply_text("❌ Нельзя забанить администратора или владельца чата!")
             return
     except Exception as e:
-        logger.error(f"Ошибка при проверке статуса пользователя: {e}")
+        logger.error("Ошибка при проверке статуса пользователя: %s", e)
 
     try:
         await context.bot.ban_chat_member(
@@ -731,6 +2394,7 @@ async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_id=target_user.id,
             until_date=duration
         )
+        audit_log.record('ban', chat_id, target_user.id, duration=duration_seconds if duration else None, reason="Ручная команда администратора", actor_id=user_id)
 
         username = target_user.username or target_user.first_name
         admin_name = update.message.from_user.username or update.message.from_user.first_name
@@ -746,7 +2410,7 @@ async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id, ban_text)
 
     except Exception as e:
-        logger.error(f"Ошибка при бане: {e}")
+        logger.error("Ошибка при бане: %s", e)
         await update.message.reply_text(f"❌ Не удалось забанить пользователя: {e}")
 
 async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -770,7 +2434,7 @@ async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
     except Exception as e:
-        logger.error(f"Ошибка при проверке прав администратора для /unban: {e}")
+        logger.error("Ошибка при проверке прав администратора для /unban: %s", e)
         await update.message.reply_text("❌ Ошибка при проверке прав доступа!")
         return
 
@@ -779,10 +2443,12 @@ async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.reply_to_message:
         target_user = update.message.reply_to_message.from_user
     elif context.args and context.args[0].startswith('@'):
-        await update.message.reply_text("❌ Поиск по username пока не поддерживается. Пожалуйста, ответьте на сообщение пользователя.")
-        return
+        target_user = find_user_by_username(chat_id, context.args[0])
+        if not target_user:
+            await update.message.reply_text(USERNAME_NOT_FOUND_TEXT.format(username=context.args[0]))
+            return
     else:
-        await update.message.reply_text("❌ Ответьте на сообщение пользователя для разбана")
+        await update.message.reply_text("❌ Ответьте на сообщение пользователя или укажите @username для разбана")
         return
 
     try:
@@ -791,6 +2457,7 @@ async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_id=target_user.id,
             only_if_banned=True
         )
+        audit_log.record('unban', chat_id, target_user.id, reason="Ручная команда администратора", actor_id=user_id)
 
         username = target_user.username or target_user.first_name
         admin_name = update.message.from_user.username or update.message.from_user.first_name
@@ -806,25 +2473,53 @@ async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(chat_id, unban_text)
 
     except Exception as e:
-        logger.error(f"Ошибка при разбане: {e}")
+        logger.error("Ошибка при разбане: %s", e)
         await update.message.reply_text(f"❌ Не удалось разбанить пользователя: {e}")
 
-async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /settings"""
-    if not update.message.chat.type in ['group', 'supergroup']:
-        await update.message.reply_text("❌ Эта команда работает только в группах!")
-        return
+# Панели /settings и /ai: рендерятся один раз на версию настроек чата
+PANEL_DEBOUNCE_SECONDS = 0.7
+
+SETTINGS_CYCLES = {
+    'punishment_type': ['warn', 'mute', 'ban'],
+    'warnings_before_punishment': [2, 3, 4, 5],
+    'rapid_messages_count': [3, 5, 7, 10],
+    'mute_duration': [60, 300, 900, 1800, 3600, 10800],
+    'ban_duration': [600, 3600, 21600, 86400],
+    'ai_response_chance': [5, 10, 25, 50, 75, 100],
+    'captcha_action': ['kick', 'ban'],
+}
 
-    user_id = update.message.from_user.id
-    chat_id = update.message.chat_id
+SETTINGS_TOGGLES = {
+    'toggle_antispam': ('antispam_enabled', True),
+    'toggle_auto_mod': ('auto_moderation', True),
+    'toggle_welcome': ('welcome_message', True),
+    'toggle_ai': ('ai_enabled', False),
+    'toggle_captcha': ('captcha_enabled', False),
+}
 
-    chat_member = await context.bot.get_chat_member(chat_id, user_id)
-    if chat_member.status not in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды!")
-        return
+SETTINGS_CHANGES = {
+    'change_punishment': ('punishment_type', 'mute'),
+    'change_warnings': ('warnings_before_punishment', 3),
+    'change_rapid_count': ('rapid_messages_count', 5),
+    'change_mute_time': ('mute_duration', 300),
+    'change_ban_time': ('ban_duration', 3600),
+    'change_ai_chance': ('ai_response_chance', 10),
+    'change_captcha_action': ('captcha_action', 'kick'),
+}
 
-    settings = get_chat_settings(chat_id)
+AI_PANEL_CALLBACKS = ('toggle_ai', 'change_ai_chance')
 
+PANEL_CALLBACK_PATTERN = r'^(toggle_|change_|back_to_settings$)'
+PANEL_MESSAGES_LIMIT = 1000
+PANEL_CACHE_LIMIT = 1000
+
+settings_versions = defaultdict(int)
+panel_cache = OrderedDict()
+panel_messages = OrderedDict()
+pending_panel_edits = {}
+
+def render_settings_panel(settings: dict):
+    """Строит текст и клавиатуру панели /settings"""
     mute_duration = settings.get('mute_duration', 300)
     ban_duration = settings.get('ban_duration', 3600)
 
@@ -835,16 +2530,20 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     current_punishment = punishment_names.get(settings.get('punishment_type', 'mute'), 'Мут')
 
     rapid_count = settings.get('rapid_messages_count', 5)
+    captcha_action = 'Бан' if settings.get('captcha_action', 'kick') == 'ban' else 'Исключение'
     ai_enabled = settings.get('ai_enabled', False)
     ai_status = '✅ Включены' if ai_enabled else '❌ Выключены'
 
+    template_line = f"📑 Шаблон: {settings['template']}\n" if settings.get('template') else ""
+
     settings_text = f"""
 ⚙️ **Настройки чата**
-
+{template_line}
 🛡️ Антиспам: {'✅ Включен' if settings.get('antispam_enabled', True) else '❌ Выключен'}
 🤖 Автомодерация: {'✅ Включена' if settings.get('auto_moderation', True) else '❌ Выключена'}
 👋 Приветствие новых: {'✅ Включено' if settings.get('welcome_message', True) else '❌ Выключено'}
 🗑️ Удаление служебных: {'✅ Включено' if settings.get('delete_service_messages', True) else '❌ Выключено'}
+🔐 Проверка новичков: {'✅ Включена' if settings.get('captcha_enabled', False) else '❌ Выключена'} (не прошедшим: {captcha_action.lower()})
 
 **Настройки наказаний:**
 ⚡ Тип наказания: {current_punishment}
@@ -901,17 +2600,108 @@ async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"🚫 Бан: {ban_time_str}",
                 callback_data='change_ban_time'
             )
+        ],
+        [
+            InlineKeyboardButton(
+                f"🔐 Проверка: {'✅' if settings.get('captcha_enabled', False) else '❌'}",
+                callback_data='toggle_captcha'
+            ),
+            InlineKeyboardButton(
+                f"👢 Не прошедшим: {captcha_action}",
+                callback_data='change_captcha_action'
+            )
         ]
     ]
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(settings_text, parse_mode='Markdown', reply_markup=reply_markup)
-
-async def warn_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /warn для выдачи предупреждений"""
-    if not update.message.chat.type in ['group', 'supergroup']:
-        await update.message.reply_text("❌ Эта команда работает только в группах!")
-        return
+    return settings_text, InlineKeyboardMarkup(keyboard)
+
+def render_ai_panel(settings: dict):
+    """Строит текст и клавиатуру панели /ai"""
+    ai_enabled = settings.get('ai_enabled', False)
+    ai_chance = settings.get('ai_response_chance', 10)
+    ai_status = '✅ Включены' if ai_enabled else '❌ Выключены'
+
+    ai_settings_text = f"""
+🧠 **Настройки ИИ ответов**
+
+🤖 Статус ИИ: {ai_status}
+📊 Шанс ответа: {ai_chance}%
+
+Для изменения настроек используйте кнопки ниже.
+"""
+
+    keyboard = [
+        [
+            InlineKeyboardButton(
+                f"🧠 ИИ: {'✅' if ai_enabled else '❌'}",
+                callback_data='toggle_ai'
+            ),
+            InlineKeyboardButton(
+                f"🎯 Шанс ответа: {ai_chance}%",
+                callback_data='change_ai_chance'
+            )
+        ],
+        [
+            InlineKeyboardButton(
+                f"🔙 К основным настройкам",
+                callback_data='back_to_settings'
+            )
+        ]
+    ]
+
+    return ai_settings_text, InlineKeyboardMarkup(keyboard)
+
+PANEL_RENDERERS = {
+    'settings': render_settings_panel,
+    'ai': render_ai_panel,
+}
+
+def get_panel(chat_id: int, panel: str):
+    """Возвращает закэшированную панель для текущей версии настроек чата"""
+    version = settings_version(chat_id)
+    key = (chat_scope(chat_id), panel)
+    cached = panel_cache.get(key)
+    if cached and cached[0] == version:
+        panel_cache.move_to_end(key)
+        return cached[1], cached[2]
+
+    text, markup = PANEL_RENDERERS[panel](get_chat_settings(chat_id))
+    panel_cache[key] = (version, text, markup)
+    panel_cache.move_to_end(key)
+    while len(panel_cache) > PANEL_CACHE_LIMIT:
+        panel_cache.popitem(last=False)
+    return text, markup
+
+def remember_panel_message(chat_id: int, message_id: int, panel: str):
+    """Запоминает, какая версия панели показана в сообщении"""
+    panel_messages[(chat_id, message_id)] = (panel, settings_version(chat_id))
+    panel_messages.move_to_end((chat_id, message_id))
+    while len(panel_messages) > PANEL_MESSAGES_LIMIT:
+        panel_messages.popitem(last=False)
+
+async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /settings"""
+    if not update.message.chat.type in ['group', 'supergroup']:
+        await update.message.reply_text("❌ Эта команда работает только в группах!")
+        return
+
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat_id
+
+    chat_member = await context.bot.get_chat_member(chat_id, user_id)
+    if chat_member.status not in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды!")
+        return
+
+    settings_text, reply_markup = get_panel(chat_id, 'settings')
+    panel_msg = await update.message.reply_text(settings_text, parse_mode='Markdown', reply_markup=reply_markup)
+    remember_panel_message(chat_id, panel_msg.message_id, 'settings')
+
+async def warn_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /warn для выдачи предупреждений"""
+    if not update.message.chat.type in ['group', 'supergroup']:
+        await update.message.reply_text("❌ Эта команда работает только в группах!")
+        return
 
     user_id = update.message.from_user.id
     chat_id = update.message.chat_id
@@ -928,7 +2718,7 @@ async def warn_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
     except Exception as e:
-        logger.error(f"Ошибка при проверке прав администратора для /warn: {e}")
+        logger.error("Ошибка при проверке прав администратора для /warn: %s", e)
         await update.message.reply_text("❌ Ошибка при проверке прав доступа!")
         return
 
@@ -939,10 +2729,18 @@ async def warn_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target_user = update.message.reply_to_message.from_user
         if context.args:
             reason = " ".join(context.args)
+    elif context.args and context.args[0].startswith('@'):
+        target_user = find_user_by_username(chat_id, context.args[0])
+        if not target_user:
+            await update.message.reply_text(USERNAME_NOT_FOUND_TEXT.format(username=context.args[0]))
+            return
+        if len(context.args) > 1:
+            reason = " ".join(context.args[1:])
     else:
         await update.message.reply_text(
             "❌ Использование команды `/warn`:\n"
             "• Ответьте на сообщение пользователя и напишите `/warn [причина]`\n"
+            "• Или укажите username: `/warn @user [причина]`\n"
             "• Пример: `/warn спам` (в ответ на сообщение)"
         )
         return
@@ -954,20 +2752,20 @@ async def warn_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ Нельзя предупредить администратора или владельца чата!")
                 return
         except Exception as e:
-            logger.error(f"Ошибка при проверке статуса пользователя: {e}")
+            logger.error("Ошибка при проверке статуса пользователя: %s", e)
 
         settings = get_chat_settings(chat_id)
         warnings_limit = settings.get('warnings_before_punishment', 3)
 
-        user_warnings[target_user.id] += 1
-        warnings_count = user_warnings[target_user.id]
+        warnings_count = warning_ledger.add(chat_id, target_user.id)
+        audit_log.record('warn', chat_id, target_user.id, reason=reason, count=warnings_count, actor_id=user_id)
 
         username = target_user.username or target_user.first_name
         admin_name = update.message.from_user.username or update.message.from_user.first_name
 
         if warnings_count >= warnings_limit:
             punishment_type = settings.get('punishment_type', 'mute')
-            user_warnings[target_user.id] = 0
+            warning_ledger.reset(chat_id, target_user.id)
 
             if punishment_type == 'mute':
                 duration = settings.get('mute_duration', 300)
@@ -1002,6 +2800,400 @@ async def warn_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             await context.bot.send_message(chat_id, warn_text, parse_mode='Markdown')
 
+async def purge_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /purge для массового удаления сообщений"""
+    if not update.message.chat.type in ['group', 'supergroup']:
+        await update.message.reply_text("❌ Эта команда работает только в группах!")
+        return
+
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat_id
+
+    try:
+        chat_member = await context.bot.get_chat_member(chat_id, user_id)
+        if chat_member.status not in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+            username = update.message.from_user.username or update.message.from_user.first_name
+            await update.message.reply_text(
+                f"❌ **ДОСТУП ЗАПРЕЩЕН**\n\n"
+                f"@{username}, у вас нет прав администратора для использования команды `/purge`.\n"
+                f"Обратитесь к администраторам группы для получения необходимых прав.",
+                parse_mode='Markdown'
+            )
+            return
+    except Exception as e:
+        logger.error("Ошибка при проверке прав администратора для /purge: %s", e)
+        await update.message.reply_text("❌ Ошибка при проверке прав доступа!")
+        return
+
+    reply = update.message.reply_to_message
+    args = context.args or []
+    max_count = PURGE_SETTINGS['max_count']
+
+    if reply and args and args[0].isdigit():
+        count = min(int(args[0]), max_count)
+        message_ids = select_purge_ids(chat_id, user_id=reply.from_user.id, limit=count)
+        message_ids.append(update.message.message_id)
+    elif reply:
+        message_ids = select_purge_ids(chat_id, since_id=reply.message_id, limit=max_count)
+        message_ids.extend([reply.message_id, update.message.message_id])
+    elif len(args) >= 2 and args[0] in ('since', 'с') and args[1].isdigit():
+        message_ids = select_purge_ids(chat_id, since_id=int(args[1]), limit=max_count)
+        message_ids.append(update.message.message_id)
+    else:
+        await update.message.reply_text(
+            "❌ Использование команды `/purge`:\n"
+            "• Ответьте на сообщение и напишите `/purge` - удалить всё, начиная с него\n"
+            "• Ответьте на сообщение и напишите `/purge 20` - удалить 20 последних сообщений автора\n"
+            "• `/purge since 12345` - удалить всё, начиная с сообщения 12345"
+        )
+        return
+
+    message_ids = sorted(set(message_ids))
+    forget_messages(chat_id, message_ids)
+    deletion_queue.submit(context.bot, chat_id, message_ids)
+
+    purge_msg = await context.bot.send_message(chat_id, f"🧹 Удаляю сообщений: {len(message_ids)}")
+    clock.run_once(context.job_queue, delete_messages_job, 10, data=(chat_id, [purge_msg.message_id]))
+
+AUDIT_ACTION_NAMES = {
+    'warn': '⚠️ предупреждение',
+    'kick': '👢 исключение',
+    'mute': '🔇 мут',
+    'unmute': '🔊 размут',
+    'ban': '🚫 бан',
+    'unban': '✅ разбан',
+}
+
+async def audit_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /audit - история модерации пользователя"""
+    if not update.message.chat.type in ['group', 'supergroup']:
+        await update.message.reply_text("❌ Эта команда работает только в группах!")
+        return
+
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat_id
+
+    try:
+        chat_member = await context.bot.get_chat_member(chat_id, user_id)
+        if chat_member.status not in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+            await update.message.reply_text("❌ У вас нет прав для выполнения этой команды!")
+            return
+    except Exception as e:
+        logger.error("Ошибка при проверке прав администратора для /audit: %s", e)
+        await update.message.reply_text("❌ Ошибка при проверке прав доступа!")
+        return
+
+    if not update.message.reply_to_message:
+        await update.message.reply_text("❌ Ответьте на сообщение пользователя, чтобы посмотреть его историю")
+        return
+
+    target_user = update.message.reply_to_message.from_user
+    events = await asyncio.to_thread(audit_log.query, chat_id, target_user.id, 10)
+
+    if not events:
+        await update.message.reply_text(f"📂 Для {target_user.first_name} нет записей в журнале модерации")
+        return
+
+    audit_text = f"📂 ЖУРНАЛ МОДЕРАЦИИ: {target_user.first_name}\n\n"
+    for event in events:
+        date_str = datetime.fromtimestamp(event['ts']).strftime('%d.%m.%Y %H:%M')
+        action_name = AUDIT_ACTION_NAMES.get(event['action'], event['action'])
+        reason = event.get('reason')
+        audit_text += f"{date_str} — {action_name}" + (f" ({reason})" if reason else "") + "\n"
+
+    await update.message.reply_text(audit_text)
+
+async def banwords_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /banwords - список запрещённых слов и фраз чата"""
+    if not update.message.chat.type in ['group', 'supergroup']:
+        await update.message.reply_text("❌ Эта команда работает только в группах!")
+        return
+
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat_id
+
+    try:
+        chat_member = await context.bot.get_chat_member(chat_id, user_id)
+        if chat_member.status not in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+            await update.message.reply_text("❌ У вас нет прав для выполнения этой команды!")
+            return
+    except Exception as e:
+        logger.error("Ошибка при проверке прав администратора для /banwords: %s", e)
+        await update.message.reply_text("❌ Ошибка при проверке прав доступа!")
+        return
+
+    words = get_banned_words(chat_id)
+    action = context.args[0].lower() if context.args else 'list'
+    # Слова и фразы разделяются запятыми или переносами строк: /banwords add казино, ставки на спорт, крипт*
+    parts = update.message.text.split(None, 2)
+    entries = [entry.strip() for entry in parts[2].replace('\n', ',').split(',') if normalize_text(entry.rstrip('*'))] if len(parts) > 2 else []
+
+    if action == 'add' and entries:
+        known = {KeywordAutomaton.needle(word) for word in words}
+        added = [entry for entry in entries if KeywordAutomaton.needle(entry) not in known]
+        if len(words) + len(added) > BANNED_WORDS_SETTINGS['max_patterns']:
+            await update.message.reply_text(f"❌ В списке может быть не больше {BANNED_WORDS_SETTINGS['max_patterns']} слов и фраз")
+            return
+        save_banned_words(chat_id, words + added)
+        await update.message.reply_text(f"✅ Добавлено: {len(added)}. Всего запрещённых слов и фраз: {len(words) + len(added)}")
+    elif action in ('del', 'remove') and entries:
+        removed = {KeywordAutomaton.needle(entry) for entry in entries}
+        kept = [word for word in words if KeywordAutomaton.needle(word) not in removed]
+        save_banned_words(chat_id, kept)
+        await update.message.reply_text(f"✅ Удалено: {len(words) - len(kept)}. Осталось: {len(kept)}")
+    elif action == 'clear':
+        save_banned_words(chat_id, [])
+        await update.message.reply_text("✅ Список запрещённых слов очищен")
+    elif action == 'list':
+        if not words:
+            await update.message.reply_text(
+                "📋 Запрещённых слов нет.\n"
+                "Добавить: /banwords add слово, фраза из слов, префикс*"
+            )
+            return
+        shown = words[:100]
+        list_text = f"🚫 ЗАПРЕЩЁННЫЕ СЛОВА ({len(words)}):\n\n" + ", ".join(shown)
+        if len(words) > len(shown):
+            list_text += f"\n… и ещё {len(words) - len(shown)}"
+        await update.message.reply_text(list_text)
+    else:
+        await update.message.reply_text(
+            "❌ Использование:\n"
+            "/banwords - показать список\n"
+            "/banwords add слово, фраза, префикс* - добавить\n"
+            "/banwords del слово, фраза - удалить\n"
+            "/banwords clear - очистить список"
+        )
+
+async def links_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /links - разрешённые и запрещённые домены чата"""
+    if not update.message.chat.type in ['group', 'supergroup']:
+        await update.message.reply_text("❌ Эта команда работает только в группах!")
+        return
+
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat_id
+
+    try:
+        chat_member = await context.bot.get_chat_member(chat_id, user_id)
+        if chat_member.status not in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+            await update.message.reply_text("❌ У вас нет прав для выполнения этой команды!")
+            return
+    except Exception as e:
+        logger.error("Ошибка при проверке прав администратора для /links: %s", e)
+        await update.message.reply_text("❌ Ошибка при проверке прав доступа!")
+        return
+
+    rules = get_link_rules(chat_id)
+    action = context.args[0].lower() if context.args else 'list'
+    domains = [domain for domain in map(registrable_domain, context.args[1:]) if domain]
+
+    if action in ('allow', 'deny') and domains:
+        other = 'deny' if action == 'allow' else 'allow'
+        for domain in domains:
+            rules[other].pop(domain, None)
+            rules[action][domain] = int(clock.time())
+        db.set(f"links_{chat_id}", rules)
+        verb = "разрешены" if action == 'allow' else "запрещены"
+        await update.message.reply_text(f"✅ Ссылки на {', '.join(domains)} {verb}")
+    elif action == 'remove' and domains:
+        for domain in domains:
+            rules['allow'].pop(domain, None)
+            rules['deny'].pop(domain, None)
+        db.set(f"links_{chat_id}", rules)
+        await update.message.reply_text(f"✅ {', '.join(domains)} убраны из списков")
+    elif action == 'list':
+        links_text = "🔗 ФИЛЬТР ССЫЛОК\n\n"
+        links_text += "✅ Разрешены: " + (", ".join(sorted(rules['allow'])) or "—") + "\n"
+        links_text += "🚫 Запрещены: " + (", ".join(sorted(rules['deny'])) or "—") + "\n\n"
+        links_text += "Остальные домены ограничиваются автоматически, если их одновременно рассылают во многие чаты."
+        await update.message.reply_text(links_text)
+    else:
+        await update.message.reply_text(
+            "❌ Использование:\n"
+            "/links - показать списки\n"
+            "/links allow домен [домен…] - разрешить\n"
+            "/links deny домен [домен…] - запретить\n"
+            "/links remove домен [домен…] - убрать из списков"
+        )
+
+async def chatstats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /chatstats - активность чата"""
+    if not update.message.chat.type in ['group', 'supergroup']:
+        await update.message.reply_text("❌ Эта команда работает только в группах!")
+        return
+
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat_id
+
+    try:
+        chat_member = await context.bot.get_chat_member(chat_id, user_id)
+        if chat_member.status not in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+            await update.message.reply_text("❌ У вас нет прав для выполнения этой команды!")
+            return
+    except Exception as e:
+        logger.error("Ошибка при проверке прав администратора для /chatstats: %s", e)
+        await update.message.reply_text("❌ Ошибка при проверке прав доступа!")
+        return
+
+    analytics = get_chat_analytics(chat_id)
+    now = clock.time()
+    day_messages = analytics.messages(24, now)
+
+    stats_text = "📈 АКТИВНОСТЬ ЧАТА\n\n"
+    stats_text += f"💬 Сообщений за последний час: {analytics.messages(1, now)}\n"
+    stats_text += f"💬 За сутки: {day_messages} (в среднем {day_messages / 24:.1f} в час)\n"
+    stats_text += f"💬 За неделю: {analytics.messages(ANALYTICS_SETTINGS['hours'], now)}\n\n"
+    stats_text += f"👥 Писали сегодня: ~{analytics.unique_users(1, now)}\n"
+    stats_text += f"👥 Писали за неделю: ~{analytics.unique_users(ANALYTICS_SETTINGS['days'], now)}\n"
+
+    top = analytics.top_posters()
+    if top:
+        stats_text += "\n🏆 Самые активные на этой неделе:\n"
+        for place, (count, name) in enumerate(top, 1):
+            stats_text += f"{place}. {name} — ~{count}\n"
+
+    await update.message.reply_text(stats_text)
+
+TEMPLATE_DURATION_FIELDS = ('mute_duration', 'ban_duration', 'captcha_timeout')
+TEMPLATE_CHOICE_FIELDS = {
+    'punishment_type': ('warn', 'mute', 'ban'),
+    'captcha_action': ('kick', 'ban'),
+}
+
+def parse_template_value(key: str, raw: str):
+    """Приводит значение поля шаблона к типу настройки; ValueError, если не подходит"""
+    if key not in DEFAULT_CHAT_SETTINGS:
+        raise ValueError(f"неизвестная настройка {key}")
+    default = DEFAULT_CHAT_SETTINGS[key]
+    if isinstance(default, bool):
+        if raw.lower() in ('on', 'true', '1', 'да', 'вкл'):
+            return True
+        if raw.lower() in ('off', 'false', '0', 'нет', 'выкл'):
+            return False
+        raise ValueError(f"{key} принимает on или off")
+    if key in TEMPLATE_DURATION_FIELDS:
+        return parse_time(raw)
+    if isinstance(default, int):
+        return int(raw)
+    if key in TEMPLATE_CHOICE_FIELDS and raw not in TEMPLATE_CHOICE_FIELDS[key]:
+        raise ValueError(f"{key} принимает: {', '.join(TEMPLATE_CHOICE_FIELDS[key])}")
+    return raw
+
+def link_chat_template(chat_id: int, template: Optional[str]):
+    """Привязывает чат к шаблону (поля шаблона перестают переопределяться) или отвязывает, сохраняя текущие значения"""
+    if template:
+        settings = dict(db.get(f"settings_{chat_id}", {}))
+        for key in get_settings_templates().get(template, {}):
+            settings.pop(key, None)
+        settings['template'] = template
+    else:
+        settings = get_chat_settings(chat_id)
+        settings.pop('template', None)
+    save_chat_settings(chat_id, settings)
+
+def format_template(name: str, fields: dict) -> str:
+    return f"📑 {name}: " + (", ".join(f"{key}={value}" for key, value in fields.items()) or "пустой")
+
+async def template_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /template - шаблоны настроек для многих чатов"""
+    user_id = update.message.from_user.id
+    chat_id = update.message.chat_id
+    action = context.args[0].lower() if context.args else 'show'
+    templates = get_settings_templates()
+    is_owner = user_id in STATS_SETTINGS['owner_ids']
+
+    # Шаблоны действуют сразу на многие чаты, поэтому меняет их только владелец бота
+    if action in ('set', 'delete', 'link', 'list'):
+        if not is_owner:
+            await update.message.reply_text("❌ Эта команда доступна только владельцу бота!")
+            return
+
+        if action == 'list':
+            if not templates:
+                await update.message.reply_text("📑 Шаблонов пока нет. Создать: /template set имя поле=значение …")
+                return
+            await update.message.reply_text("\n".join(format_template(name, fields) for name, fields in templates.items()))
+            return
+
+        if len(context.args) < 2:
+            await update.message.reply_text("❌ Укажите имя шаблона")
+            return
+        name = context.args[1]
+
+        if action == 'set':
+            fields = dict(templates.get(name, {}))
+            try:
+                for assignment in context.args[2:]:
+                    key, _, raw = assignment.partition('=')
+                    fields[key] = parse_template_value(key, raw)
+            except ValueError as e:
+                await update.message.reply_text(f"❌ Ошибка в шаблоне: {e}")
+                return
+            templates[name] = fields
+            save_settings_templates(templates)
+            await update.message.reply_text(f"✅ Шаблон сохранён\n{format_template(name, fields)}")
+        elif action == 'delete':
+            if templates.pop(name, None) is None:
+                await update.message.reply_text(f"❌ Шаблона {name} нет")
+                return
+            save_settings_templates(templates)
+            await update.message.reply_text(f"✅ Шаблон {name} удалён, привязанные чаты вернулись к своим настройкам")
+        else:
+            if name not in templates:
+                await update.message.reply_text(f"❌ Шаблона {name} нет")
+                return
+            try:
+                chat_ids = [int(arg) for arg in context.args[2:]]
+            except ValueError:
+                await update.message.reply_text("❌ Использование: /template link имя id_чата [id_чата …]")
+                return
+            for linked_chat_id in chat_ids:
+                link_chat_template(linked_chat_id, name)
+            await update.message.reply_text(f"✅ К шаблону {name} привязано чатов: {len(chat_ids)}")
+        return
+
+    if not update.message.chat.type in ['group', 'supergroup']:
+        await update.message.reply_text("❌ Эта команда работает только в группах!")
+        return
+
+    try:
+        chat_member = await context.bot.get_chat_member(chat_id, user_id)
+        if chat_member.status not in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+            await update.message.reply_text("❌ У вас нет прав для выполнения этой команды!")
+            return
+    except Exception as e:
+        logger.error("Ошибка при проверке прав администратора для /template: %s", e)
+        await update.message.reply_text("❌ Ошибка при проверке прав доступа!")
+        return
+
+    current = db.get(f"settings_{chat_id}", {}).get('template')
+    if action == 'use' and len(context.args) > 1:
+        name = context.args[1]
+        if name not in templates:
+            await update.message.reply_text(f"❌ Шаблона {name} нет")
+            return
+        link_chat_template(chat_id, name)
+        await update.message.reply_text(f"✅ Чат привязан к шаблону\n{format_template(name, templates[name])}")
+    elif action == 'off':
+        if not current:
+            await update.message.reply_text("📑 Чат не привязан к шаблону")
+            return
+        link_chat_template(chat_id, None)
+        await update.message.reply_text(f"✅ Чат отвязан от шаблона {current}, текущие значения сохранены как собственные")
+    elif action == 'show':
+        if not current:
+            await update.message.reply_text("📑 Чат не привязан к шаблону. Привязать: /template use имя")
+            return
+        await update.message.reply_text(format_template(current, templates.get(current, {})))
+    else:
+        await update.message.reply_text(
+            "❌ Использование:\n"
+            "/template - шаблон этого чата\n"
+            "/template use имя - привязать чат к шаблону\n"
+            "/template off - отвязать чат"
+        )
+
 async def rules_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /rules для показа или установки правил"""
     if not update.message.chat.type in ['group', 'supergroup']:
@@ -1024,7 +3216,7 @@ async def rules_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
         except Exception as e:
-            logger.error(f"Ошибка при проверке прав администратора для команды /rules: {e}")
+            logger.error("Ошибка при проверке прав администратора для команды /rules: %s", e)
             await update.message.reply_text("❌ Ошибка при проверке прав доступа!")
             return
 
@@ -1059,42 +3251,85 @@ async def ai_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ У вас нет прав для выполнения этой команды!")
         return
 
-    settings = get_chat_settings(chat_id)
+    ai_settings_text, reply_markup = get_panel(chat_id, 'ai')
+    panel_msg = await update.message.reply_text(ai_settings_text, parse_mode='Markdown', reply_markup=reply_markup)
+    remember_panel_message(chat_id, panel_msg.message_id, 'ai')
 
-    ai_enabled = settings.get('ai_enabled', False)
-    ai_chance = settings.get('ai_response_chance', 10)
-    ai_status = '✅ Включены' if ai_enabled else '❌ Выключены'
+async def settings_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик кнопок панелей /settings и /ai"""
+    query = update.callback_query
+    chat_id = query.message.chat_id
+    message_id = query.message.message_id
 
-    ai_settings_text = f"""
-🧠 **Настройки ИИ ответов**
+    try:
+        chat_member = await context.bot.get_chat_member(chat_id, query.from_user.id)
+        if chat_member.status not in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+            await query.answer("❌ У вас нет прав для изменения настроек!", show_alert=True)
+            return
+    except Exception as e:
+        logger.error("Ошибка при проверке прав администратора для кнопок настроек: %s", e)
+        await query.answer("❌ Ошибка при проверке прав доступа!")
+        return
 
-🤖 Статус ИИ: {ai_status}
-📊 Шанс ответа: {ai_chance}%
+    # Быстрые повторные нажатия копятся в одной отложенной правке
+    key = (chat_id, message_id)
+    pending = pending_panel_edits.get(key)
+    if pending is None:
+        pending = {
+            'panel': 'ai' if query.data in AI_PANEL_CALLBACKS else 'settings',
+            'changes': {},
+        }
+        pending_panel_edits[key] = pending
+        clock.run_once(context.job_queue, flush_panel_edit_job, PANEL_DEBOUNCE_SECONDS, data=key)
+
+    # Копим только изменённые ключи: правки из разных панелей одного чата не затирают друг друга
+    changes = pending['changes']
+    settings = get_chat_settings(chat_id)
+    if query.data in SETTINGS_TOGGLES:
+        setting, default = SETTINGS_TOGGLES[query.data]
+        changes[setting] = not changes.get(setting, settings.get(setting, default))
+    elif query.data in SETTINGS_CHANGES:
+        setting, default = SETTINGS_CHANGES[query.data]
+        values = SETTINGS_CYCLES[setting]
+        current = changes.get(setting, settings.get(setting, default))
+        position = values.index(current) if current in values else -1
+        changes[setting] = values[(position + 1) % len(values)]
+
+    if query.data == 'back_to_settings':
+        pending['panel'] = 'settings'
+    elif query.data in AI_PANEL_CALLBACKS:
+        pending['panel'] = 'ai'
+
+    await query.answer()
+
+async def flush_panel_edit_job(context: ContextTypes.DEFAULT_TYPE):
+    """Применяет накопленные изменения настроек одной записью и одной правкой"""
+    chat_id, message_id = context.job.data
+    pending = pending_panel_edits.pop((chat_id, message_id), None)
+    if pending is None:
+        return
 
-Для изменения настроек используйте кнопки ниже.
-"""
+    settings = dict(get_chat_settings(chat_id))
+    if any(settings.get(setting) != value for setting, value in pending['changes'].items()):
+        settings.update(pending['changes'])
+        save_chat_settings(chat_id, settings)
 
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                f"🧠 ИИ: {'✅' if ai_enabled else '❌'}",
-                callback_data='toggle_ai'
-            ),
-            InlineKeyboardButton(
-                f"🎯 Шанс ответа: {ai_chance}%",
-                callback_data='change_ai_chance'
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                f"🔙 К основным настройкам",
-                callback_data='back_to_settings'
-            )
-        ]
-    ]
+    panel = pending['panel']
+    if panel_messages.get((chat_id, message_id)) == (panel, settings_version(chat_id)):
+        return
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(ai_settings_text, parse_mode='Markdown', reply_markup=reply_markup)
+    text, reply_markup = get_panel(chat_id, panel)
+    try:
+        await context.bot.edit_message_text(
+            text,
+            chat_id=chat_id,
+            message_id=message_id,
+            parse_mode='Markdown',
+            reply_markup=reply_markup
+        )
+        remember_panel_message(chat_id, message_id, panel)
+    except Exception as e:
+        logger.error("Ошибка при обновлении панели настроек: %s", e)
 
 
 async def russian_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1126,7 +3361,7 @@ async def russian_command_handler(update: Update, context: ContextTypes.DEFAULT_
                 )
                 return
         except Exception as e:
-            logger.error(f"Ошибка при проверке прав администратора для русских команд: {e}")
+            logger.error("Ошибка при проверке прав администратора для русских команд: %s", e)
             return
 
     rp_commands = {
@@ -1339,7 +3574,7 @@ async def russian_command_handler(update: Update, context: ContextTypes.DEFAULT_
 
         try:
             permissions = ChatPermissions(can_send_messages=False)
-            until_date = datetime.now() + timedelta(seconds=duration)
+            until_date = clock.now() + timedelta(seconds=duration)
 
             await context.bot.restrict_chat_member(
                 chat_id=chat_id,
@@ -1347,6 +3582,7 @@ async def russian_command_handler(update: Update, context: ContextTypes.DEFAULT_
                 permissions=permissions,
                 until_date=until_date
             )
+            audit_log.record('mute', chat_id, target_user.id, duration=duration, reason="Команда администратора (русская)", actor_id=user_id)
 
             if duration < 60:
                 time_str = f"{duration} секунд"
@@ -1370,10 +3606,7 @@ async def russian_command_handler(update: Update, context: ContextTypes.DEFAULT_
 
             await context.bot.send_message(chat_id, mute_text)
 
-            context.job_queue.run_once(
-                lambda context: unmute_user_job(context, chat_id, target_user.id),
-                duration
-            )
+            schedule_unmute(context.job_queue, chat_id, target_user.id, duration)
 
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка при муте: {e}")
@@ -1389,7 +3622,7 @@ async def russian_command_handler(update: Update, context: ContextTypes.DEFAULT_
 
         if len(parts) > 1:
             duration_seconds = parse_time(parts[1])
-            duration = datetime.now() + timedelta(seconds=duration_seconds)
+            duration = clock.now() + timedelta(seconds=duration_seconds)
 
             if duration_seconds < 60:
                 duration_text = f"{duration_seconds} секунд"
@@ -1416,6 +3649,7 @@ async def russian_command_handler(update: Update, context: ContextTypes.DEFAULT_
                 user_id=target_user.id,
                 until_date=duration
             )
+            audit_log.record('ban', chat_id, target_user.id, duration=duration_seconds if duration else None, reason="Команда администратора (русская)", actor_id=user_id)
 
             username = target_user.username or target_user.first_name
             admin_name = update.message.from_user.username or update.message.from_user.first_name
@@ -1453,6 +3687,7 @@ async def russian_command_handler(update: Update, context: ContextTypes.DEFAULT_
                 user_id=target_user.id,
                 permissions=permissions
             )
+            audit_log.record('unmute', chat_id, target_user.id, reason="Команда администратора (русская)", actor_id=user_id)
 
             username = target_user.username or target_user.first_name
             admin_name = update.message.from_user.username or update.message.from_user.first_name
@@ -1468,3 +3703,1504 @@ async def russian_command_handler(update: Update, context: ContextTypes.DEFAULT_
 
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка при размуте: {e}")
+
+# Вступления участников: приветствия и служебные сообщения собираются пачками
+JOIN_SETTINGS = {
+    'window': 5,
+    'silent_threshold': 20,
+    'silent_duration': 600,
+    'max_mentions': 30,
+    # Один и тот же вход приходит и как chat_member, и как служебное сообщение
+    'dedupe_window': 60,
+}
+
+pending_joins = {}
+silent_until = {}
+recent_joins = OrderedDict()
+
+# Проверка новых участников (капча)
+CAPTCHA_SETTINGS = {
+    'tick': 1.0,
+    'wheel_slots': 64,
+    'wheel_levels': 3,
+    'kick_batch': 20,
+}
+
+CAPTCHA_BUTTON_DATA = 'captcha'
+
+class TimingWheel:
+    """Иерархическое колесо таймеров: вставка, отмена и срабатывание за O(1) на таймер.
+
+    Уровень 0 — слоты по одному тику, каждый следующий уровень в slots раз грубее.
+    Когда время доходит до слота грубого уровня, его таймеры раскладываются
+    уровнем ниже. Отмена ленивая: запись остаётся в слоте и отбрасывается при проходе.
+    """
+
+    def __init__(self, tick: float, slots: int, levels: int, now: float):
+        self.tick = tick
+        self.slots = slots
+        self._wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self._overflow = []
+        self._deadlines = {}
+        self._current = int(now // tick)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def insert(self, key, deadline: float):
+        self._deadlines[key] = deadline
+        self._place(key, deadline, self._current + 1)
+
+    def cancel(self, key):
+        self._deadlines.pop(key, None)
+
+    def _place(self, key, deadline: float, earliest: int):
+        target = max(math.ceil(deadline / self.tick), earliest)
+        for level, wheel in enumerate(self._wheels):
+            span = self.slots ** (level + 1)
+            if target // span == self._current // span:
+                wheel[(target // self.slots ** level) % self.slots].append((key, deadline))
+                return
+        self._overflow.append((key, deadline))
+
+    def _cascade(self, entries: list):
+        for key, deadline in entries:
+            if self._deadlines.get(key) == deadline:
+                # Слот текущего тика нулевого уровня ещё не пройден
+                self._place(key, deadline, self._current)
+
+    def _rebuild(self, target: int) -> list:
+        # Скачок времени больше оборота колеса: дешевле разложить живые таймеры заново
+        live = self._deadlines
+        self._wheels = [[[] for _ in range(self.slots)] for _ in self._wheels]
+        self._overflow = []
+        self._deadlines = {}
+        self._current = target
+        expired = []
+        for key, deadline in live.items():
+            if math.ceil(deadline / self.tick) <= target:
+                expired.append(key)
+            else:
+                self.insert(key, deadline)
+        return expired
+
+    def advance(self, now: float) -> list:
+        """Сдвигает колесо до now и возвращает ключи сработавших таймеров"""
+        target = int(now // self.tick)
+        if target - self._current > self.slots ** len(self._wheels):
+            return self._rebuild(target)
+
+        expired = []
+        while self._current < target:
+            self._current += 1
+            if self._current % self.slots ** len(self._wheels) == 0:
+                overflow, self._overflow = self._overflow, []
+                self._cascade(overflow)
+            for level in range(len(self._wheels) - 1, 0, -1):
+                span = self.slots ** level
+                if self._current % span == 0:
+                    slot = self._wheels[level][(self._current // span) % self.slots]
+                    entries = slot[:]
+                    slot.clear()
+                    self._cascade(entries)
+
+            slot = self._wheels[0][self._current % self.slots]
+            for key, deadline in slot:
+                if self._deadlines.get(key) == deadline:
+                    del self._deadlines[key]
+                    expired.append(key)
+            slot.clear()
+        return expired
+
+captcha_wheels = {}
+captcha_messages = Counter()
+
+def captcha_wheel() -> TimingWheel:
+    """Колесо проверок текущего бота"""
+    namespace = storage_namespace.get()
+    wheel = captcha_wheels.get(namespace)
+    if wheel is None:
+        wheel = captcha_wheels[namespace] = TimingWheel(
+            CAPTCHA_SETTINGS['tick'], CAPTCHA_SETTINGS['wheel_slots'], CAPTCHA_SETTINGS['wheel_levels'], clock.time()
+        )
+    return wheel
+
+def _release_captcha_message(chat_id: int, message_id: Optional[int]) -> bool:
+    """Снимает одну ссылку на сообщение с кнопкой; True, если оно больше никому не нужно"""
+    if not message_id:
+        return False
+    ref = (chat_scope(chat_id), message_id)
+    captcha_messages[ref] -= 1
+    if captcha_messages[ref] > 0:
+        return False
+    del captcha_messages[ref]
+    return True
+
+async def start_captcha(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user) -> bool:
+    """Ограничивает нового участника до нажатия кнопки; True, если проверка назначена"""
+    settings = get_chat_settings(chat_id)
+    if user.is_bot or not settings.get('captcha_enabled', False):
+        return False
+
+    key = f"{chat_id}:{user.id}"
+    pending = db.get("pending_captchas", {})
+    if key in pending:
+        return True
+
+    try:
+        await context.bot.restrict_chat_member(
+            chat_id=chat_id,
+            user_id=user.id,
+            permissions=ChatPermissions(can_send_messages=False)
+        )
+    except Exception as e:
+        joins_logger.error("Ошибка при ограничении нового участника: %s", e)
+        return False
+
+    deadline = clock.time() + settings.get('captcha_timeout', 120)
+    pending[key] = [deadline, None]
+    db.set("pending_captchas", pending)
+    captcha_wheel().insert(key, deadline)
+    return True
+
+def restore_pending_captchas():
+    """Возвращает в колесо проверки, начатые до перезапуска"""
+    wheel = captcha_wheel()
+    for key, (deadline, message_id) in db.get("pending_captchas", {}).items():
+        wheel.insert(key, deadline)
+        if message_id:
+            captcha_messages[(chat_scope(int(key.split(':')[0])), message_id)] += 1
+
+async def send_captcha_challenge(context: ContextTypes.DEFAULT_TYPE, chat_id: int, names: list, user_ids: set):
+    """Одно сообщение с кнопкой на всё окно вступлений"""
+    timeout = get_chat_settings(chat_id).get('captcha_timeout', 120)
+    if names:
+        shown = names[:JOIN_SETTINGS['max_mentions']]
+        challenge_text = f"👋 Добро пожаловать, {', '.join(shown)}!"
+        if len(names) > len(shown):
+            challenge_text += f" И ещё {len(names) - len(shown)} новых участников!"
+    else:
+        challenge_text = "👋 Добро пожаловать, новые участники!"
+    challenge_text += f"\n🔐 Чтобы писать в чат, нажмите кнопку ниже в течение {timeout} секунд."
+
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("✅ Я не бот", callback_data=CAPTCHA_BUTTON_DATA)]])
+    try:
+        challenge = await context.bot.send_message(chat_id, challenge_text, reply_markup=keyboard)
+    except Exception as e:
+        joins_logger.error("Ошибка при отправке проверки новичков: %s", e)
+        return
+
+    pending = db.get("pending_captchas", {})
+    for user_id in user_ids:
+        entry = pending.get(f"{chat_id}:{user_id}")
+        if entry is not None and entry[1] is None:
+            entry[1] = challenge.message_id
+            captcha_messages[(chat_scope(chat_id), challenge.message_id)] += 1
+    db.set("pending_captchas", pending)
+
+async def captcha_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Нажатие «Я не бот»: снимаем ограничение с того, кто нажал"""
+    query = update.callback_query
+    chat_id = query.message.chat_id
+    user_id = query.from_user.id
+    key = f"{chat_id}:{user_id}"
+
+    pending = db.get("pending_captchas", {})
+    entry = pending.pop(key, None)
+    if entry is None:
+        await query.answer("Эта проверка не для вас")
+        return
+    db.set("pending_captchas", pending)
+    captcha_wheel().cancel(key)
+
+    try:
+        await context.bot.restrict_chat_member(
+            chat_id=chat_id,
+            user_id=user_id,
+            permissions=ChatPermissions(
+                can_send_messages=True,
+                can_send_media_messages=True,
+                can_send_other_messages=True,
+                can_add_web_page_previews=True
+            )
+        )
+    except Exception as e:
+        joins_logger.error("Ошибка при снятии ограничения после проверки: %s", e)
+
+    await query.answer("✅ Проверка пройдена, добро пожаловать!")
+    if _release_captcha_message(chat_id, entry[1]):
+        deletion_queue.submit(context.bot, chat_id, [entry[1]])
+
+async def remove_unverified(bot, chat_id: int, user_id: int, action: str):
+    """Исключает или банит не прошедшего проверку"""
+    while True:
+        try:
+            await bot.ban_chat_member(chat_id, user_id)
+            if action != 'ban':
+                await bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
+            audit_log.record('ban' if action == 'ban' else 'kick', chat_id, user_id, reason="не прошёл проверку")
+            return
+        except RetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            joins_logger.error("Ошибка при исключении не прошедшего проверку: %s", e)
+            return
+
+async def expire_captchas(bot, keys: list):
+    """Пачками убирает всех, у кого истекло время проверки, и удаляет ненужные сообщения с кнопкой"""
+    pending = db.get("pending_captchas", {})
+    expired = defaultdict(list)
+    challenges = defaultdict(list)
+    for key in keys:
+        entry = pending.pop(key, None)
+        if entry is None:
+            continue
+        chat_id, user_id = map(int, key.split(':'))
+        expired[chat_id].append(user_id)
+        if _release_captcha_message(chat_id, entry[1]):
+            challenges[chat_id].append(entry[1])
+    db.set("pending_captchas", pending)
+
+    batch = CAPTCHA_SETTINGS['kick_batch']
+    for chat_id, user_ids in expired.items():
+        action = get_chat_settings(chat_id).get('captcha_action', 'kick')
+        for start in range(0, len(user_ids), batch):
+            await asyncio.gather(*(remove_unverified(bot, chat_id, user_id, action) for user_id in user_ids[start:start + batch]))
+        joins_logger.info("Проверку не прошли в чате %s: %s (%s)", chat_id, len(user_ids), 'бан' if action == 'ban' else 'исключение')
+        if challenges[chat_id]:
+            deletion_queue.submit(bot, chat_id, challenges[chat_id])
+
+async def captcha_tick_job(context: ContextTypes.DEFAULT_TYPE):
+    """Поворачивает колесо проверок; истёкшие обрабатываются отдельной задачей"""
+    expired = captcha_wheel().advance(clock.time())
+    if expired:
+        context.application.create_task(expire_captchas(context.bot, expired))
+
+def _pending_join_batch(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> dict:
+    """Возвращает открытое окно вступлений чата, открывая новое при необходимости"""
+    batch = pending_joins.get(chat_scope(chat_id))
+    if batch is None:
+        batch = {'users': OrderedDict(), 'service_ids': [], 'captcha': set()}
+        pending_joins[chat_scope(chat_id)] = batch
+        clock.run_once(context.job_queue, flush_join_batch_job, JOIN_SETTINGS['window'], data=chat_id)
+    return batch
+
+def _is_duplicate_join(chat_id: int, user_id: int) -> bool:
+    """True, если этот вход уже учтён: недавно пришёл другим апдейтом или по нему уже отправлена проверка"""
+    now = clock.time()
+    while recent_joins and next(iter(recent_joins.values())) <= now:
+        recent_joins.popitem(last=False)
+
+    key = (*chat_scope(chat_id), user_id)
+    if key in recent_joins:
+        return True
+    entry = db.get("pending_captchas", {}).get(f"{chat_id}:{user_id}")
+    if entry is not None and entry[1] is not None:
+        return True
+    recent_joins[key] = now + JOIN_SETTINGS['dedupe_window']
+    return False
+
+def register_join(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user, captcha: bool = False):
+    """Добавляет вступившего пользователя в текущее окно чата"""
+    if user.is_bot:
+        return
+    if _is_duplicate_join(chat_id, user.id):
+        return
+    batch = _pending_join_batch(context, chat_id)
+    batch['users'][user.id] = f"@{user.username}" if user.username else user.first_name
+    if captcha:
+        batch['captcha'].add(user.id)
+
+def register_service_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int):
+    """Ставит служебное сообщение на пакетное удаление"""
+    if not get_chat_settings(chat_id).get('delete_service_messages', True):
+        return
+    _pending_join_batch(context, chat_id)['service_ids'].append(message_id)
+
+async def flush_join_batch_job(context: ContextTypes.DEFAULT_TYPE):
+    """Закрывает окно: одно приветствие на всех и одно пакетное удаление"""
+    chat_id = context.job.data
+    batch = pending_joins.pop(chat_scope(chat_id), None)
+    if batch is None:
+        return
+
+    if batch['service_ids']:
+        deletion_queue.submit(context.bot, chat_id, batch['service_ids'])
+
+    names = list(batch['users'].values())
+    if not names:
+        return
+
+    now = clock.time()
+    if len(names) >= JOIN_SETTINGS['silent_threshold']:
+        if silent_until.get(chat_scope(chat_id), 0) <= now:
+            joins_logger.warning("Волна вступлений в чате %s: %s за %s с, приветствия отключены", chat_id, len(names), JOIN_SETTINGS['window'])
+        silent_until[chat_scope(chat_id)] = now + JOIN_SETTINGS['silent_duration']
+    silent = silent_until.get(chat_scope(chat_id), 0) > now
+
+    # С проверкой приветствие заменяет сообщение с кнопкой, в тихом режиме без упоминаний
+    if batch['captcha']:
+        await send_captcha_challenge(context, chat_id, [] if silent else names, batch['captcha'])
+        return
+    if silent:
+        return
+
+    if not get_chat_settings(chat_id).get('welcome_message', True):
+        return
+
+    shown = names[:JOIN_SETTINGS['max_mentions']]
+    welcome_text = f"👋 Добро пожаловать, {', '.join(shown)}!"
+    if len(names) > len(shown):
+        welcome_text += f" И ещё {len(names) - len(shown)} новых участников!"
+    welcome_text += "\n📋 Ознакомьтесь с правилами чата: /rules"
+
+    try:
+        await context.bot.send_message(chat_id, welcome_text)
+    except Exception as e:
+        joins_logger.error("Ошибка при отправке приветствия: %s", e)
+
+async def chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отслеживает вступления через обновления chat_member"""
+    result = update.chat_member
+    if not result:
+        return
+
+    old_status = result.old_chat_member.status
+    new_status = result.new_chat_member.status
+    if old_status in [ChatMemberStatus.LEFT, ChatMemberStatus.BANNED] and new_status in [ChatMemberStatus.MEMBER, ChatMemberStatus.RESTRICTED]:
+        user = result.new_chat_member.user
+        captcha = await start_captcha(context, result.chat.id, user)
+        # Приветствовать вступивших во время простоя уже поздно, проверку же всё равно проходят
+        if captcha or not catch_up.is_stale(update):
+            register_join(context, result.chat.id, user, captcha)
+
+async def service_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Служебные сообщения о входе и выходе: учитываем вступивших и удаляем пачкой"""
+    message = update.message
+    if not message:
+        return
+
+    stale = catch_up.is_stale(update)
+    for member in message.new_chat_members or ():
+        captcha = await start_captcha(context, message.chat_id, member)
+        if captcha or not stale:
+            register_join(context, message.chat_id, member, captcha)
+    register_service_message(context, message.chat_id, message.message_id)
+
+async def track_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запоминает каждое сообщение группы для /purge, справочника username и статистики"""
+    message = update.message
+    if message and message.from_user:
+        remember_message(message.chat_id, message.message_id, message.from_user.id)
+        remember_user(message.chat_id, message.from_user)
+        record_activity(message.chat_id, message.from_user, clock.time())
+        if message.reply_to_message:
+            remember_user(message.chat_id, message.reply_to_message.from_user)
+        for member in message.new_chat_members or ():
+            remember_user(message.chat_id, member)
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Основной обработчик сообщений в группах"""
+    if not update.message or not update.message.from_user:
+        return
+
+    if await check_spam(update, context):
+        return
+
+    # Команды, накопившиеся за простой, выполняются так же, как слэш-команды;
+    # пропускаются только ответы, которые бот пишет сам
+    await russian_command_handler(update, context)
+
+    if catch_up.is_stale(update):
+        catch_up.skipped += 1
+        return
+
+    message_text = update.message.text
+    if not message_text:
+        return
+
+    chat_id = update.message.chat_id
+    settings = get_chat_settings(chat_id)
+    if not settings.get('ai_enabled', False):
+        return
+
+    import random
+
+    response = await get_smart_ai_response(message_text, update.message.from_user.id, chat_id)
+    if response and random.randint(1, 100) <= settings.get('ai_response_chance', 10):
+        await update.message.reply_text(response)
+
+async def persist_analytics_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически переносит статистику активности из памяти в базу"""
+    persist_analytics()
+
+async def flush_db_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически сбрасывает изменённые шарды на диск"""
+    expiry_index.persist()
+    db.flush()
+
+async def catch_up_job(context: ContextTypes.DEFAULT_TYPE):
+    """Завершает догоняние, если очередь разобрана, а свежих апдейтов так и не пришло"""
+    catch_up.check_idle()
+
+async def expiry_sweep_job(context: ContextTypes.DEFAULT_TYPE):
+    """Проходит очередной бакет пользовательских ключей и удаляет просроченные"""
+    await expiry_index.sweep_next()
+
+# HTTP-транспорт Bot API: отдельные пулы для getUpdates и исходящих вызовов
+TRANSPORT_SETTINGS = {
+    'updates': {
+        'pool_size': 1,
+        'connect_timeout': 5.0,
+        'read_timeout': 5.0,
+        'write_timeout': 5.0,
+        'pool_timeout': 1.0,
+        'keepalive_expiry': 60.0,
+        'http_version': '1.1',
+    },
+    'outbound': {
+        'pool_size': int(os.environ.get('BOT_API_POOL_SIZE', 32)),
+        'connect_timeout': 5.0,
+        'read_timeout': 10.0,
+        'write_timeout': 10.0,
+        'pool_timeout': float(os.environ.get('BOT_API_POOL_TIMEOUT', 3.0)),
+        'keepalive_expiry': float(os.environ.get('BOT_API_KEEPALIVE', 30.0)),
+        'http_version': os.environ.get('BOT_API_HTTP_VERSION', '1.1'),
+    },
+    'report_interval': 300,
+}
+
+class MeasuredHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest, который считает время ожидания свободного соединения в пуле.
+
+    Запросы проходят через семафор размером с пул, поэтому httpx никогда не ждёт
+    сам, а ожидание семафора и есть ожидание пула.
+    """
+
+    def __init__(self, name: str, pool_size: int, keepalive_expiry: float, pool_timeout: float, **kwargs):
+        self.name = name
+        self.pool_size = pool_size
+        self.keepalive_expiry = keepalive_expiry
+        self.default_pool_timeout = pool_timeout
+        self._slots = asyncio.Semaphore(pool_size)
+        self._waits = deque(maxlen=1000)
+        self.requests = 0
+        self.pool_timeouts = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        super().__init__(connection_pool_size=pool_size, pool_timeout=pool_timeout, **kwargs)
+
+    def _build_client(self):
+        limits = self._client_kwargs.get('limits')
+        if limits is not None:
+            self._client_kwargs['limits'] = httpx.Limits(
+                max_connections=limits.max_connections,
+                max_keepalive_connections=limits.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            )
+        return super()._build_client()
+
+    async def do_request(self, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.default_pool_timeout)
+        except asyncio.TimeoutError:
+            self.pool_timeouts += 1
+            raise TimedOut(f"Пул соединений {self.name} занят дольше {self.default_pool_timeout} с")
+
+        self._waits.append(time.monotonic() - started)
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await super().do_request(*args, **kwargs)
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        return {
+            'pool_size': self.pool_size,
+            'requests': self.requests,
+            'pool_timeouts': self.pool_timeouts,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'wait_avg_ms': round(sum(waits) / len(waits) * 1000, 2) if waits else 0.0,
+            'wait_p95_ms': round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 2) if waits else 0.0,
+            'wait_max_ms': round(waits[-1] * 1000, 2) if waits else 0.0,
+        }
+
+transport_requests = {}
+
+def make_request(name: str, label: str = None) -> MeasuredHTTPXRequest:
+    """Создаёт транспорт с настройками TRANSPORT_SETTINGS[name]"""
+    settings = dict(TRANSPORT_SETTINGS[name])
+    if settings['http_version'] == '2':
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            transport_logger.warning("HTTP/2 недоступен (нужен пакет httpx[http2]), используется HTTP/1.1")
+            settings['http_version'] = '1.1'
+
+    request = MeasuredHTTPXRequest(
+        label or name,
+        pool_size=settings['pool_size'],
+        keepalive_expiry=settings['keepalive_expiry'],
+        pool_timeout=settings['pool_timeout'],
+        connect_timeout=settings['connect_timeout'],
+        read_timeout=settings['read_timeout'],
+        write_timeout=settings['write_timeout'],
+        http_version=settings['http_version'],
+    )
+    transport_requests[label or name] = request
+    return request
+
+async def transport_report_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически пишет в лог метрики пулов, чтобы подбирать их размер"""
+    for name, request in transport_requests.items():
+        stats = request.stats()
+        transport_logger.info(
+            "Пул %s: размер %s, запросов %s, ожидание avg %s мс / p95 %s мс / max %s мс, "
+            "одновременно до %s, таймаутов пула %s",
+            name, stats['pool_size'], stats['requests'], stats['wait_avg_ms'], stats['wait_p95_ms'],
+            stats['wait_max_ms'], stats['max_in_flight'], stats['pool_timeouts']
+        )
+
+# Диагностика для владельца бота: /stats и HTTP-эндпоинт
+STATS_SETTINGS = {
+    'owner_ids': {int(owner) for owner in os.environ.get('BOT_OWNER_IDS', '').split(',') if owner.strip()},
+    'http_host': os.environ.get('STATS_HOST', '127.0.0.1'),
+    'http_port': int(os.environ.get('STATS_PORT', 0)),
+    'http_token': os.environ.get('STATS_TOKEN'),
+    'size_sample': 32,
+    'top_chats': 10,
+    'lag_interval': 1.0,
+}
+
+def deep_size(obj, seen=None) -> int:
+    """Глубокий размер объекта в байтах (для небольших выборок)"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+def estimate_size(container: dict, sample: int = None) -> int:
+    """Оценивает глубокий размер словаря по первым элементам, не обходя его целиком"""
+    sample = sample or STATS_SETTINGS['size_sample']
+    items = list(itertools.islice(container.items(), sample))
+    if not items:
+        return sys.getsizeof(container)
+    sampled = sum(deep_size(key) + deep_size(value) for key, value in items)
+    return sys.getsizeof(container) + sampled * len(container) // len(items)
+
+class RateCounter:
+    """Счётчик событий в кольце слотов фиксированной ширины: добавление O(1), сумма за окно O(слотов)"""
+
+    def __init__(self, slot_seconds: int, slots: int):
+        self.slot_seconds = slot_seconds
+        self._counts = [0] * slots
+        self._stamps = [0] * slots
+
+    def add(self, now: float, count: int = 1):
+        stamp = int(now // self.slot_seconds)
+        i = stamp % len(self._counts)
+        if self._stamps[i] != stamp:
+            self._stamps[i] = stamp
+            self._counts[i] = 0
+        self._counts[i] += count
+
+    def total(self, now: float) -> int:
+        oldest = int(now // self.slot_seconds) - len(self._counts)
+        return sum(count for count, stamp in zip(self._counts, self._stamps) if stamp > oldest)
+
+update_rates = {
+    'minute': RateCounter(1, 60),
+    'hour': RateCounter(60, 60),
+}
+
+def count_update():
+    now = time.monotonic()
+    for counter in update_rates.values():
+        counter.add(now)
+
+class LoopLagMonitor:
+    """Замеряет, насколько позже положенного просыпается задача в цикле событий"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = deque(maxlen=60)
+        self.loop = None
+        self._task = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._task = self.loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            started = self.loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, self.loop.time() - started - self.interval))
+
+    def stats(self) -> dict:
+        samples = list(self.samples)
+        return {
+            'last_ms': round(samples[-1] * 1000, 2) if samples else 0.0,
+            'avg_ms': round(sum(samples) / len(samples) * 1000, 2) if samples else 0.0,
+            'max_ms': round(max(samples) * 1000, 2) if samples else 0.0,
+        }
+
+loop_lag = LoopLagMonitor(STATS_SETTINGS['lag_interval'])
+
+def top_chats(limit: int) -> list:
+    """Чаты с наибольшим объёмом: размер шарда на диске плюс кольцо сообщений для /purge"""
+    entry_size = deep_size((0, 0))
+    footprints = {}
+    for shard_id, size in db.footprints.items():
+        base = shard_id.rpartition('.')[2]
+        if base.startswith('chat_'):
+            chat_id = int(base[len('chat_'):])
+            footprints[chat_id] = footprints.get(chat_id, 0) + size
+    for (_, chat_id), ring in recent_chat_messages.items():
+        footprints[chat_id] = footprints.get(chat_id, 0) + len(ring) * entry_size
+    return heapq.nlargest(limit, footprints.items(), key=lambda item: item[1])
+
+def collect_stats() -> dict:
+    """Собирает диагностику; вызывается в цикле событий бота"""
+    db_stats = db.stats()
+    now = time.monotonic()
+    return {
+        'uptime_seconds': round(now - PROCESS_STARTED, 1),
+        'memory_bytes': {
+            'db_global_shard': db.footprints.get(GLOBAL_SHARD, 0),
+            'db_resident_shards': db_stats['resident_bytes'],
+            'user_message_history': estimate_size(user_message_history),
+            'recent_chat_messages': estimate_size(recent_chat_messages),
+            'panel_cache': estimate_size(panel_cache),
+            'audit_index': audit_log.stats()['index_bytes'],
+        },
+        'db': {
+            'resident_shards': db_stats['resident_shards'],
+            'dirty_shards': db_stats['dirty_shards'],
+            'known_shards': db_stats['known_shards'],
+            'keys_by_prefix': {prefix: count for prefix, count in db.key_counts.most_common() if count},
+        },
+        'top_chats': [{'chat_id': chat_id, 'bytes': size} for chat_id, size in top_chats(STATS_SETTINGS['top_chats'])],
+        'updates': {name: counter.total(now) for name, counter in update_rates.items()},
+        'loop_lag': loop_lag.stats(),
+        'transport': {name: request.stats() for name, request in transport_requests.items()},
+        'startup': {name: round(value, 3) for name, value in startup_stats.items()},
+        'catch_up': catch_up.stats(),
+        'logging': {
+            'queued': log_handler.queue.qsize() if log_handler else 0,
+            'dropped': log_handler.dropped if log_handler else 0,
+        },
+    }
+
+def format_size(size: int) -> str:
+    for unit in ('Б', 'КБ', 'МБ'):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /stats - диагностика памяти и нагрузки (только для владельца бота)"""
+    if update.message.from_user.id not in STATS_SETTINGS['owner_ids']:
+        await update.message.reply_text("❌ Эта команда доступна только владельцу бота!")
+        return
+
+    stats = collect_stats()
+    stats_text = f"📊 ДИАГНОСТИКА (аптайм {timedelta(seconds=int(stats['uptime_seconds']))})\n\n"
+    stats_text += "Память:\n"
+    for name, size in stats['memory_bytes'].items():
+        stats_text += f"• {name}: {format_size(size)}\n"
+    stats_text += (
+        f"\nШарды: в памяти {stats['db']['resident_shards']}, изменённых {stats['db']['dirty_shards']}, "
+        f"всего известно {stats['db']['known_shards']}\n"
+    )
+    stats_text += "Ключи: " + ", ".join(f"{prefix} {count}" for prefix, count in stats['db']['keys_by_prefix'].items()) + "\n"
+    stats_text += "\nКрупнейшие чаты:\n"
+    for chat in stats['top_chats']:
+        stats_text += f"• {chat['chat_id']}: {format_size(chat['bytes'])}\n"
+    stats_text += (
+        f"\nАпдейтов: за минуту {stats['updates']['minute']}, за час {stats['updates']['hour']}\n"
+        f"Задержка цикла событий: сейчас {stats['loop_lag']['last_ms']} мс, "
+        f"средняя {stats['loop_lag']['avg_ms']} мс, макс {stats['loop_lag']['max_ms']} мс"
+    )
+    drain = stats['catch_up']['last_drain']
+    if stats['catch_up']['active']:
+        stats_text += "\nИдёт разбор апдейтов, накопившихся за простой"
+    elif drain:
+        stats_text += (
+            f"\nПоследнее догоняние: {drain['updates']} апдейтов за {drain['seconds']:.1f} с, "
+            f"самый старый {drain['oldest_age_seconds']} с"
+        )
+
+    await update.message.reply_text(stats_text)
+
+class StatsRequestHandler(BaseHTTPRequestHandler):
+    """GET /stats: та же диагностика в JSON, собирается в цикле событий бота"""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/stats':
+            self.send_error(404)
+            return
+        token = STATS_SETTINGS['http_token']
+        if token and self.headers.get('Authorization') != f"Bearer {token}":
+            self.send_error(403)
+            return
+
+        async def collect():
+            return collect_stats()
+
+        try:
+            stats = asyncio.run_coroutine_threadsafe(collect(), loop_lag.loop).result(timeout=5)
+        except Exception as e:
+            logger.error("Ошибка при сборе диагностики: %s", e)
+            self.send_error(503)
+            return
+
+        body = json.dumps(stats, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stats_server():
+    """Поднимает HTTP-эндпоинт диагностики, если задан STATS_PORT"""
+    if not STATS_SETTINGS['http_port']:
+        return None
+    server = ThreadingHTTPServer((STATS_SETTINGS['http_host'], STATS_SETTINGS['http_port']), StatsRequestHandler)
+    threading.Thread(target=server.serve_forever, name='stats-http', daemon=True).start()
+    logger.info("Диагностика доступна на http://%s:%s/stats", STATS_SETTINGS['http_host'], STATS_SETTINGS['http_port'])
+    return server
+
+# Запись входящих апдейтов для последующего воспроизведения (loadtest.py replay)
+TRACE_SETTINGS = {
+    'directory': os.environ.get('TRACE_DIRECTORY'),
+    'segment_size': 64 * 1024 * 1024,
+}
+
+class TraceRecorder:
+    """Пишет поток апдейтов в ротируемые gzip-файлы JSONL из отдельного потока"""
+
+    def __init__(self, directory: str, segment_size: int):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._prefix = datetime.now().strftime('trace_%Y%m%d_%H%M%S')
+        self._queue = queue.Queue()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._writer, name='trace-recorder', daemon=True)
+        self._thread.start()
+
+    def record(self, update_data: dict):
+        self._queue.put((clock.time(), update_data))
+
+    def _writer(self):
+        segment = 0
+        segment_bytes = 0
+        trace_file = None
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            ts, update_data = item
+            line = json.dumps({'ts': ts, 'update': update_data}, ensure_ascii=False, separators=(',', ':')) + '\n'
+            if trace_file is None or segment_bytes >= self.segment_size:
+                if trace_file is not None:
+                    trace_file.close()
+                segment += 1
+                segment_bytes = 0
+                path = os.path.join(self.directory, f"{self._prefix}_{segment:04d}.jsonl.gz")
+                trace_file = gzip.open(path, 'wt', encoding='utf-8')
+
+            trace_file.write(line)
+            segment_bytes += len(line)
+            if self._queue.empty():
+                trace_file.flush()
+
+        if trace_file is not None:
+            trace_file.close()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+trace_recorder = None
+if TRACE_SETTINGS['directory']:
+    trace_recorder = TraceRecorder(TRACE_SETTINGS['directory'], TRACE_SETTINGS['segment_size'])
+    atexit.register(trace_recorder.close)
+
+def iter_trace(paths):
+    """Читает записанные апдейты: (время получения, словарь апдейта)"""
+    for path in paths:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                yield item['ts'], item['update']
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сохраняет каждый входящий апдейт в трассу"""
+    trace_recorder.record(update.to_dict())
+
+# Потоковый экспорт данных для офлайн-анализа
+EXPORT_SETTINGS = {
+    'directory': 'export',
+    'chunk_size': 50000,
+}
+
+EXPORT_CSV_FIELDS = ['type', 'chat_id', 'user_id', 'ts', 'action', 'data', 'bot']
+
+def _shard_records(chat_id: int, shard: dict):
+    settings = shard.get(f"settings_{chat_id}")
+    if settings is not None:
+        yield {'type': 'settings', 'chat_id': chat_id, 'data': settings}
+    for user_id, marriage in shard.get(f"marriages_{chat_id}", {}).items():
+        yield {'type': 'marriage', 'chat_id': chat_id, 'user_id': int(user_id), 'data': marriage}
+    for user_id, (count, last_ts) in shard.get(f"warnings_{chat_id}", {}).items():
+        yield {'type': 'warnings', 'chat_id': chat_id, 'user_id': int(user_id), 'ts': last_ts, 'data': {'count': count}}
+
+def iter_shard_records(directory: str, after=None):
+    """Отдаёт записи чатов всех ботов, держа в памяти только один шард.
+
+    Шарды других ботов называются brand.chat_-100.json: пространство имён
+    попадает в поле bot записи, а имя файла с ним - в курсор.
+    """
+    names = sorted(
+        name for name in os.listdir(directory)
+        if name.endswith('.json') and name[:-len('.json')].rpartition('.')[2].startswith('chat_')
+    )
+    for name in names:
+        if after and name < after[0]:
+            continue
+        namespace, _, base = name[:-len('.json')].rpartition('.')
+        chat_id = int(base[len('chat_'):])
+        try:
+            with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+                shard = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            db_logger.error("Ошибка при чтении шарда %s: %s", name, e)
+            continue
+        for i, record in enumerate(_shard_records(chat_id, shard)):
+            if after and name == after[0] and i <= after[1]:
+                continue
+            if namespace:
+                record['bot'] = namespace
+            yield ['chats', name, i], record
+
+def iter_audit_records(directory: str, after=None):
+    """Построчно отдаёт события журнала модерации; автоматические помечаются как spam_verdict"""
+    if not os.path.isdir(directory):
+        return
+    segments = sorted(
+        int(name[len('segment_'):-len('.jsonl')])
+        for name in os.listdir(directory)
+        if name.startswith('segment_') and name.endswith('.jsonl')
+    )
+    for segment in segments:
+        if after and segment < after[0]:
+            continue
+        with open(os.path.join(directory, f"segment_{segment:06d}.jsonl"), 'rb') as f:
+            if after and segment == after[0]:
+                f.seek(after[1])
+            for line in iter(f.readline, b''):
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                record = {
+                    'type': 'audit' if 'actor_id' in event else 'spam_verdict',
+                    'chat_id': event.pop('chat_id'),
+                    'user_id': event.pop('user_id'),
+                    'ts': event.pop('ts'),
+                    'action': event.pop('action'),
+                    'data': event,
+                }
+                if 'bot' in event:
+                    record['bot'] = event.pop('bot')
+                yield ['audit', segment, f.tell()], record
+
+def iter_export_records(position=None):
+    """Все записи экспорта по порядку, начиная после позиции курсора"""
+    if not position or position[0] == 'chats':
+        yield from iter_shard_records(db.directory, position[1:] if position else None)
+        position = None
+    yield from iter_audit_records(audit_log.directory, position[1:] if position else None)
+
+def _open_export_chunk(path: str, compress: bool):
+    if compress:
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    return open(path, 'w', encoding='utf-8', newline='')
+
+def write_export_chunks(out_dir: str, fmt: str = 'ndjson', compress: bool = False,
+                        chunk_size: int = 50000, resume: bool = False) -> int:
+    """Пишет экспорт кусками по chunk_size записей, сохраняя курсор после каждого куска"""
+    os.makedirs(out_dir, exist_ok=True)
+    cursor_path = os.path.join(out_dir, 'cursor.json')
+
+    cursor = {}
+    if resume:
+        try:
+            with open(cursor_path, 'r', encoding='utf-8') as f:
+                cursor = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            cursor = {}
+
+    chunk_no = cursor.get('chunk', 0)
+    extension = ('csv' if fmt == 'csv' else 'ndjson') + ('.gz' if compress else '')
+    written = 0
+    chunk_file = writer = None
+    chunk_path = tmp_path = None
+    chunk_records = 0
+    position = cursor.get('position')
+
+    def close_chunk():
+        nonlocal chunk_file, chunk_no
+        chunk_file.close()
+        os.replace(tmp_path, chunk_path)
+        chunk_file = None
+        chunk_no += 1
+        with open(cursor_path, 'w', encoding='utf-8') as f:
+            json.dump({'chunk': chunk_no, 'position': position}, f)
+
+    for position, record in iter_export_records(cursor.get('position')):
+        if chunk_file is None:
+            chunk_path = os.path.join(out_dir, f"records_{chunk_no + 1:06d}.{extension}")
+            tmp_path = f"{chunk_path}.tmp"
+            chunk_file = _open_export_chunk(tmp_path, compress)
+            if fmt == 'csv':
+                writer = csv.DictWriter(chunk_file, fieldnames=EXPORT_CSV_FIELDS)
+                writer.writeheader()
+            chunk_records = 0
+
+        if fmt == 'csv':
+            row = dict(record)
+            row['data'] = json.dumps(record.get('data'), ensure_ascii=False)
+            writer.writerow(row)
+        else:
+            chunk_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+        chunk_records += 1
+        written += 1
+        if chunk_records >= chunk_size:
+            close_chunk()
+
+    if chunk_file is not None:
+        close_chunk()
+
+    return written
+
+def export_cli(argv):
+    """python main.py export - выгрузка без запуска бота"""
+    parser = argparse.ArgumentParser(prog='main.py export', description='Потоковый экспорт данных модерации')
+    parser.add_argument('--out', default=EXPORT_SETTINGS['directory'], help='каталог для файлов экспорта')
+    parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+    parser.add_argument('--gzip', action='store_true', help='сжимать куски gzip')
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_SETTINGS['chunk_size'])
+    parser.add_argument('--resume', action='store_true', help='продолжить с сохранённого курсора')
+    args = parser.parse_args(argv)
+
+    started = time.monotonic()
+    written = write_export_chunks(args.out, args.format, args.gzip, args.chunk_size, args.resume)
+    logger.info("Экспорт завершён: %s записей за %.1f с в %s", written, time.monotonic() - started, args.out)
+
+# Снимки состояния
+SNAPSHOT_SETTINGS = {
+    'directory': 'snapshots',
+    'interval': 6 * 3600,
+    'retention': int(os.environ.get('SNAPSHOT_RETENTION', 5)),
+}
+
+snapshot_lock = asyncio.Lock()
+
+def stage_snapshot(storage) -> str:
+    """Фиксирует состояние на момент вызова: сбрасывает шарды и делает жёсткие ссылки на их файлы.
+
+    Шарды всегда перезаписываются через os.replace, поэтому связанные файлы
+    больше не меняются, и упаковку можно делать в отдельном потоке.
+    """
+    storage.flush()
+    staging = os.path.join(SNAPSHOT_SETTINGS['directory'], f".staging_{time.time_ns()}")
+    os.makedirs(staging)
+    for name in os.listdir(storage.directory):
+        if not name.endswith('.json'):
+            continue
+        source = os.path.join(storage.directory, name)
+        try:
+            os.link(source, os.path.join(staging, name))
+        except OSError:
+            shutil.copy2(source, os.path.join(staging, name))
+    return staging
+
+def list_snapshots() -> list:
+    try:
+        names = os.listdir(SNAPSHOT_SETTINGS['directory'])
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names if name.startswith('snapshot_') and name.endswith('.pkl.gz'))
+
+def prune_snapshots(retention: int):
+    """Оставляет только retention последних снимков"""
+    for name in list_snapshots()[:-retention] if retention > 0 else []:
+        os.remove(os.path.join(SNAPSHOT_SETTINGS['directory'], name))
+
+def write_snapshot(staging: str, created: float) -> str:
+    """Упаковывает зафиксированные шарды в сжатый снимок (вызывается вне цикла событий)"""
+    name = datetime.fromtimestamp(created).strftime('snapshot_%Y%m%d_%H%M%S.pkl.gz')
+    path = os.path.join(SNAPSHOT_SETTINGS['directory'], name)
+    tmp_path = f"{path}.tmp"
+
+    with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+        pickle.dump({'version': 1, 'created': created}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        for shard_name in sorted(os.listdir(staging)):
+            try:
+                with open(os.path.join(staging, shard_name), 'r', encoding='utf-8') as shard_file:
+                    shard = json.load(shard_file)
+            except json.JSONDecodeError as e:
+                db_logger.error("Шард %s пропущен при создании снимка: %s", shard_name, e)
+                continue
+            pickle.dump((shard_name[:-len('.json')], shard), f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(None, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(tmp_path, path)
+    shutil.rmtree(staging, ignore_errors=True)
+    prune_snapshots(SNAPSHOT_SETTINGS['retention'])
+    return path
+
+def iter_snapshot(path: str):
+    """Потоково читает шарды из снимка. Снимки - доверенные локальные файлы (pickle)"""
+    with gzip.open(path, 'rb') as f:
+        pickle.load(f)
+        while True:
+            item = pickle.load(f)
+            if item is None:
+                break
+            yield item
+
+def restore_snapshot(path: str, directory: str) -> int:
+    """Восстанавливает каталог шардов из снимка; бот в это время должен быть остановлен"""
+    restoring = f"{directory}.restoring"
+    shutil.rmtree(restoring, ignore_errors=True)
+    os.makedirs(restoring)
+
+    count = 0
+    for shard_id, shard in iter_snapshot(path):
+        with open(os.path.join(restoring, f"{shard_id}.json"), 'w', encoding='utf-8') as f:
+            json.dump(shard, f, ensure_ascii=False)
+        count += 1
+
+    if os.path.isdir(directory):
+        os.replace(directory, f"{directory}.before_restore_{int(time.time())}")
+    os.replace(restoring, directory)
+    return count
+
+async def snapshot_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодический снимок состояния без блокировки цикла событий"""
+    if snapshot_lock.locked():
+        return
+
+    async with snapshot_lock:
+        created = time.time()
+        try:
+            staging = stage_snapshot(db)
+            path = await asyncio.to_thread(write_snapshot, staging, created)
+            db_logger.info("Снимок состояния сохранён: %s (%.1f с)", path, time.time() - created)
+        except Exception as e:
+            db_logger.error("Ошибка при создании снимка: %s", e)
+
+def snapshot_cli(argv):
+    """python main.py snapshot create|list|restore PATH"""
+    parser = argparse.ArgumentParser(prog='main.py snapshot', description='Снимки состояния бота')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    subparsers.add_parser('create', help='сделать снимок текущих данных')
+    subparsers.add_parser('list', help='показать сохранённые снимки')
+    restore_parser = subparsers.add_parser('restore', help='восстановить данные из снимка (бот должен быть остановлен)')
+    restore_parser.add_argument('path')
+    args = parser.parse_args(argv)
+
+    if args.action == 'create':
+        created = time.time()
+        path = write_snapshot(stage_snapshot(db), created)
+        logger.info("Снимок сохранён: %s (%.1f с)", path, time.time() - created)
+    elif args.action == 'list':
+        for name in list_snapshots():
+            print(os.path.join(SNAPSHOT_SETTINGS['directory'], name))
+    else:
+        started = time.monotonic()
+        count = restore_snapshot(args.path, db.directory)
+        logger.info("Восстановлено шардов: %s за %.2f с", count, time.monotonic() - started)
+
+# Перезапуск без простоя: старый процесс передаёт новому состояние из памяти
+HANDOFF_SETTINGS = {
+    'path': os.environ.get('HANDOFF_FILE', 'handoff.pickle'),
+    # Сколько новый процесс ждёт файл от старого, прежде чем начать опрос (0 - не ждать)
+    'wait': float(os.environ.get('HANDOFF_WAIT', 0)),
+    'max_age': 300,
+    # Меняется вместе с форматом состояния: файл другой версии не принимается
+    'version': 3,
+}
+
+# Одноразовые задачи, которые переносятся в новый процесс (размуты и капчи и так хранятся в базе)
+HANDOFF_JOBS = {
+    'delete_messages': delete_messages_job,
+    'flush_join_batch': flush_join_batch_job,
+    'flush_panel_edit': flush_panel_edit_job,
+}
+
+handoff_jobs = defaultdict(list)
+# Снимок задач останавливаемых ботов: после Application.stop() планировщик выключен и jobs() пуст
+outgoing_jobs = defaultdict(list)
+
+def snapshot_handoff_jobs(application):
+    """Запоминает одноразовые задачи бота для передачи; вызывается до application.stop()"""
+    job_names = {callback: name for name, callback in HANDOFF_JOBS.items()}
+    namespace = application.bot_data.get('storage_namespace', '')
+    for job in application.job_queue.jobs():
+        name = job_names.get(job.callback)
+        if name is not None and job.next_t is not None:
+            outgoing_jobs[namespace].append((name, job.next_t.timestamp(), job.data))
+
+def write_handoff(applications: list):
+    """Сохраняет горячее состояние и отложенные задачи остановленных ботов для следующего процесса.
+
+    Вызывается последним, после сброса базы: появление файла означает, что
+    новый процесс может читать базу и начинать опрос. Задачи берутся из снимка
+    snapshot_handoff_jobs, сделанного до остановки планировщика.
+    """
+    started = time.monotonic()
+    now = clock.time()
+    namespaces = {id(application.bot): application.bot_data.get('storage_namespace', '') for application in applications}
+
+    jobs = defaultdict(list, {namespace: list(items) for namespace, items in outgoing_jobs.items()})
+    for bot, chat_id, message_ids in deletion_queue.drain():
+        jobs[namespaces.get(id(bot), '')].append(('delete_messages', now, (chat_id, message_ids)))
+
+    payload = {
+        'version': HANDOFF_SETTINGS['version'],
+        'written': now,
+        'jobs': dict(jobs),
+        'user_message_history': {scope: list(history) for scope, history in user_message_history.items()},
+        'recent_chat_messages': {scope: list(ring) for scope, ring in recent_chat_messages.items()},
+        'pending_joins': pending_joins,
+        'silent_until': silent_until,
+        'recent_joins': recent_joins,
+        'pending_panel_edits': pending_panel_edits,
+        'panel_messages': panel_messages,
+        # Версии в panel_messages сравниваются с этими счётчиками, без них правки панелей терялись бы
+        'settings_versions': settings_versions,
+        'templates_versions': templates_versions,
+        'spam_fingerprints': spam_fingerprints._entries,
+        'domain_rates': domain_rates._entries,
+    }
+    path = HANDOFF_SETTINGS['path']
+    with open(f"{path}.tmp", 'wb') as f:
+        pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{path}.tmp", path)
+    logger.info(
+        "Состояние передано в %s: задач %s, %.0f мс",
+        path, sum(len(items) for items in jobs.values()), (time.monotonic() - started) * 1000
+    )
+
+def load_handoff() -> bool:
+    """Поднимает состояние, оставленное предыдущим процессом; файл используется один раз"""
+    path = HANDOFF_SETTINGS['path']
+    waited = False
+    deadline = time.monotonic() + HANDOFF_SETTINGS['wait']
+    while not os.path.exists(path) and time.monotonic() < deadline:
+        waited = True
+        time.sleep(0.05)
+
+    started = time.monotonic()
+    try:
+        with open(path, 'rb') as f:
+            payload = pickle.load(f)
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        logger.warning("Файл передачи состояния %s не прочитан: %s", path, e)
+        payload = None
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    if payload is None:
+        return False
+
+    if payload.get('version') != HANDOFF_SETTINGS['version']:
+        logger.warning("Файл передачи состояния другой версии (%s), пропускаем", payload.get('version'))
+        return False
+
+    age = clock.time() - payload['written']
+    if age > HANDOFF_SETTINGS['max_age']:
+        logger.warning("Файл передачи состояния записан %.0f с назад, пропускаем", age)
+        return False
+
+    # База была прочитана при импорте, а старый процесс сбросил её только перед записью файла
+    if waited:
+        db.reload()
+
+    for scope, history in payload['user_message_history'].items():
+        user_message_history[scope].extend(history)
+    for scope, ring in payload['recent_chat_messages'].items():
+        recent_chat_messages[scope].extend(ring)
+    pending_joins.update(payload['pending_joins'])
+    silent_until.update(payload['silent_until'])
+    recent_joins.update(payload.get('recent_joins', {}))
+    pending_panel_edits.update(payload['pending_panel_edits'])
+    panel_messages.update(payload['panel_messages'])
+    settings_versions.update(payload.get('settings_versions', {}))
+    templates_versions.update(payload.get('templates_versions', {}))
+    spam_fingerprints._entries.update(payload['spam_fingerprints'])
+    domain_rates._entries.update(payload['domain_rates'])
+    for namespace, jobs in payload['jobs'].items():
+        handoff_jobs[namespace].extend(jobs)
+
+    startup_stats['handoff_seconds'] = time.monotonic() - started
+    logger.info("Принято состояние предыдущего процесса (записано %.2f с назад)", age)
+    return True
+
+def restore_handoff_jobs(job_queue, namespace: str):
+    """Заново планирует задачи, переданные предыдущим процессом"""
+    now = clock.time()
+    for name, due, data in handoff_jobs.pop(namespace, ()):
+        clock.run_once(job_queue, HANDOFF_JOBS[name], max(0, due - now), data=data)
+
+async def report_startup():
+    """Пишет в лог, сколько занял старт до готовности принимать апдейты, и запускает диагностику"""
+    loop_lag.start()
+    start_stats_server()
+    startup_stats['ready_seconds'] = time.monotonic() - PROCESS_STARTED
+    logger.info(
+        "Старт: база %.0f мс (из бинарного файла шардов: %s), индекс журнала %.0f мс, "
+        "передача состояния %.0f мс, готов через %.2f с после запуска процесса",
+        startup_stats.get('db_load_seconds', 0) * 1000, startup_stats.get('db_warm_shards', 0),
+        startup_stats.get('audit_index_seconds', 0) * 1000, startup_stats.get('handoff_seconds', 0) * 1000,
+        startup_stats['ready_seconds']
+    )
+
+async def observe_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Считает апдейты для /stats, засекает время до первого из них и время догоняния после простоя"""
+    count_update()
+    catch_up.observe(update)
+    if 'first_update_seconds' not in startup_stats:
+        startup_stats['first_update_seconds'] = time.monotonic() - PROCESS_STARTED
+        logger.info("Первый апдейт получен через %.2f с после запуска", startup_stats['first_update_seconds'])
+
+class BotContext(CallbackContext):
+    """Контекст, который перед обработчиком или задачей выставляет пространство имён хранилища бота"""
+
+    @classmethod
+    def from_update(cls, update, application):
+        storage_namespace.set(application.bot_data.get('storage_namespace', ''))
+        if isinstance(update, Update):
+            log_context.set((
+                update.effective_chat.id if update.effective_chat else None,
+                update.effective_user.id if update.effective_user else None,
+            ))
+        return super().from_update(update, application)
+
+    @classmethod
+    def from_job(cls, job, application):
+        storage_namespace.set(application.bot_data.get('storage_namespace', ''))
+        log_context.set((None, None))
+        return super().from_job(job, application)
+
+def build_application(token: str, base_url: str = None, namespace: str = '', outbound=None, shared_jobs: bool = True):
+    """Собирает приложение со всеми обработчиками и фоновыми задачами.
+
+    namespace отделяет данные бота в общем хранилище, outbound позволяет
+    нескольким ботам делить один пул исходящих соединений, а shared_jobs
+    включает общие для процесса задачи (сброс базы, снимки, отчёт о пулах).
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .context_types(ContextTypes(context=BotContext))
+        .request(outbound or make_request('outbound'))
+        .get_updates_request(make_request('updates', f"updates.{namespace}" if namespace else None))
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+    application.bot_data['storage_namespace'] = namespace
+
+    application.add_handler(TypeHandler(Update, observe_update), group=-3)
+    if trace_recorder is not None:
+        application.add_handler(TypeHandler(Update, record_update), group=-2)
+    application.add_handler(MessageHandler(filters.ChatType.GROUPS, track_message), group=-1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("mute", mute_command))
+    application.add_handler(CommandHandler("unmute", unmute_command))
+    application.add_handler(CommandHandler("ban", ban_command))
+    application.add_handler(CommandHandler("unban", unban_command))
+    application.add_handler(CommandHandler("warn", warn_command))
+    application.add_handler(CommandHandler("purge", purge_command))
+    application.add_handler(CommandHandler("audit", audit_command))
+    application.add_handler(CommandHandler("settings", settings_command))
+    application.add_handler(CommandHandler("rules", rules_command))
+    application.add_handler(CommandHandler("banwords", banwords_command))
+    application.add_handler(CommandHandler("links", links_command))
+    application.add_handler(CommandHandler("chatstats", chatstats_command))
+    application.add_handler(CommandHandler("template", template_command))
+    application.add_handler(CommandHandler("ai", ai_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CallbackQueryHandler(settings_button_callback, pattern=PANEL_CALLBACK_PATTERN))
+    application.add_handler(CallbackQueryHandler(captcha_button_callback, pattern=f"^{CAPTCHA_BUTTON_DATA}$"))
+    application.add_handler(ChatMemberHandler(chat_member_update, ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(MessageHandler(
+        filters.ChatType.GROUPS & (filters.StatusUpdate.NEW_CHAT_MEMBERS | filters.StatusUpdate.LEFT_CHAT_MEMBER),
+        service_message_handler
+    ))
+    application.add_handler(MessageHandler(filters.ChatType.GROUPS & ~filters.COMMAND, handle_message))
+
+    application.job_queue.run_repeating(expiry_sweep_job, interval=EXPIRY_SETTINGS['sweep_interval'])
+    application.job_queue.run_repeating(captcha_tick_job, interval=CAPTCHA_SETTINGS['tick'])
+    if shared_jobs:
+        application.job_queue.run_repeating(flush_db_job, interval=DB_SETTINGS['flush_interval'])
+        application.job_queue.run_repeating(catch_up_job, interval=1)
+        application.job_queue.run_repeating(persist_analytics_job, interval=ANALYTICS_SETTINGS['persist_interval'])
+        application.job_queue.run_repeating(snapshot_job, interval=SNAPSHOT_SETTINGS['interval'])
+        application.job_queue.run_repeating(transport_report_job, interval=TRANSPORT_SETTINGS['report_interval'])
+
+    token = storage_namespace.set(namespace)
+    try:
+        restore_pending_unmutes(application.job_queue)
+        restore_pending_captchas()
+    finally:
+        storage_namespace.reset(token)
+    restore_handoff_jobs(application.job_queue, namespace)
+    audit_log.start()
+
+    return application
+
+# Несколько ботов в одном процессе
+MULTI_BOT_SETTINGS = {
+    'config': os.environ.get('BOTS_CONFIG', 'bots.json'),
+}
+
+def load_bot_configs(path: str) -> list:
+    """Читает конфиг вида {"bots": [{"name": "brand", "token": "...", "namespace": "brand", "base_url": null}]}.
+
+    namespace по умолчанию совпадает с name; пустой namespace (не больше
+    одного) означает данные однобот-режима.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    bots = config['bots'] if isinstance(config, dict) else config
+    namespaces = set()
+    for bot in bots:
+        bot.setdefault('namespace', bot['name'])
+        namespace = bot['namespace']
+        if not all(ch.isalnum() or ch in '_-' for ch in namespace):
+            raise ValueError(f"Недопустимое пространство имён {namespace!r}: только буквы, цифры, _ и -")
+        if namespace in namespaces:
+            raise ValueError(f"Пространство имён {namespace!r} указано у нескольких ботов")
+        namespaces.add(namespace)
+    return bots
+
+async def serve(applications: list, stop: asyncio.Event = None):
+    """Опрашивает Bot API до SIGINT/SIGTERM (или события stop) и передаёт состояние следующему процессу
+
+    Вместо run_polling: одноразовые задачи нужно снять до application.stop(),
+    который выключает планировщик.
+    """
+    stop = stop or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    started = []
+    try:
+        for application in applications:
+            await application.initialize()
+            await application.start()
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            started.append(application)
+        await report_startup()
+        logger.info("Запущено ботов: %s", len(started))
+        await stop.wait()
+    finally:
+        # Сначала перестаём получать апдейты и дожидаемся обработки уже полученных:
+        # задачи, запланированные этими обработчиками, тоже попадут в снимок
+        for application in started:
+            await application.updater.stop()
+        for application in started:
+            await application.update_queue.join()
+            snapshot_handoff_jobs(application)
+        # Исходящий пул общий: shutdown любого бота закрывает его, поэтому
+        # закрываем только после того, как остановлены все
+        for application in started:
+            await application.stop()
+        for application in started:
+            await application.shutdown()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+        persist_analytics()
+        expiry_index.persist()
+        db.write_warm_start()
+        write_handoff(started)
+
+async def run_bots(bots: list):
+    """Запускает всех ботов на одном цикле событий с общим хранилищем и пулом исходящих соединений"""
+    load_handoff()
+    outbound = make_request('outbound')
+    applications = [
+        build_application(bot['token'], bot.get('base_url'), bot['namespace'], outbound, shared_jobs=(i == 0))
+        for i, bot in enumerate(bots)
+    ]
+    await serve(applications)
+
+def multi_cli(argv):
+    """python main.py multi [CONFIG] - несколько ботов в одном процессе"""
+    parser = argparse.ArgumentParser(prog='main.py multi', description='Запуск нескольких ботов в одном процессе')
+    parser.add_argument('config', nargs='?', default=MULTI_BOT_SETTINGS['config'], help='JSON-файл со списком ботов')
+    args = parser.parse_args(argv)
+    asyncio.run(run_bots(load_bot_configs(args.config)))
+
+def main():
+    """Запуск бота"""
+    token = os.environ.get('BOT_TOKEN')
+    if not token:
+        logger.error("Не задана переменная окружения BOT_TOKEN")
+        return
+
+    load_handoff()
+    application = build_application(token, os.environ.get('BOT_API_BASE_URL'))
+
+    logger.info("Бот запущен")
+    asyncio.run(serve([application]))
+
+CLI_COMMANDS = {
+    'export': export_cli,
+    'snapshot': snapshot_cli,
+    'multi': multi_cli,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        CLI_COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        main()